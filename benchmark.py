@@ -0,0 +1,349 @@
+import argparse
+import itertools
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from png_viewer import png_reader, filters, image, pipeline
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SIZES = {
+    'thumb': (64, 64),
+    'vga': (640, 480),
+    '2mp': (1920, 1080),
+    '12mp': (4000, 3000),
+    '50mp': (8660, 5774)
+}
+
+FILTER_NAMES = ('none', 'sub', 'up', 'average', 'paeth')
+
+PALETTE_SIZES = (2, 16, 256)
+
+STAGES = ('read', 'inflate', 'unfilter', 'unpack', 'rgb')
+
+IDAT_SIZE = 8192
+
+# samples generated and filtered at a time, so large images are built
+# in bands instead of full-size arrays
+BAND_SAMPLES = 2 ** 22
+
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def make_chunk(chunk_type, data):
+    return struct.pack('!L', len(data)) + chunk_type + data + \
+        struct.pack('!L', zlib.crc32(chunk_type + data))
+
+
+def make_samples(width, height, channels, bit_depth, palette_size,
+                 random, y0, y1):
+    """Returns a (y1 - y0, width * channels) array of the sample values
+    of rows y0..y1.
+
+    Samples are gradients with some noise, which compress about as well
+    as photographs do, or palette indices of small blocks of colour.
+    """
+    y, x = numpy.ogrid[y0:y1, 0:width * channels]
+    if palette_size:
+        return (x // 8 + y // 8) % palette_size
+    max_value = 2 ** bit_depth - 1
+    noise = random.integers(0, max(2, max_value // 32 + 1),
+                            (y1 - y0, width * channels))
+    return (x * max_value // max(1, width * channels - 1) +
+            y * max_value // max(1, height - 1) + noise) % (max_value + 1)
+
+
+def pack_samples(samples, bit_depth):
+    """Packs sample values into scanlines of bytes"""
+    if bit_depth == 16:
+        return samples.astype('>u2').view(numpy.uint8)
+    if bit_depth == 8:
+        return samples.astype(numpy.uint8)
+    per_byte = 8 // bit_depth
+    height, width = samples.shape
+    padded = numpy.zeros((height, -(-width // per_byte) * per_byte),
+                         dtype=numpy.uint8)
+    padded[:, :width] = samples
+    padded = padded.reshape(height, -1, per_byte)
+    rows = numpy.zeros(padded.shape[:2], dtype=numpy.uint8)
+    for i in range(per_byte):
+        rows |= padded[:, :, i] << (8 - bit_depth * (i + 1))
+    return rows
+
+
+def filter_scanlines(rows, filter_type, filter_unit, previous=None):
+    """Applies one filter type to every row and prepends its type byte.
+
+    Previous is the row above the first one, if any.
+    """
+    raw = rows.astype(numpy.int16)
+    left = numpy.zeros_like(raw)
+    left[:, filter_unit:] = raw[:, :-filter_unit]
+    above = numpy.zeros_like(raw)
+    above[1:] = raw[:-1]
+    if previous is not None:
+        above[0] = previous
+    upper_left = numpy.zeros_like(raw)
+    upper_left[:, filter_unit:] = above[:, :-filter_unit]
+
+    if filter_type == 0:
+        predicted = 0
+    elif filter_type == 1:
+        predicted = left
+    elif filter_type == 2:
+        predicted = above
+    elif filter_type == 3:
+        predicted = (left + above) >> 1
+    else:
+        p = left + above - upper_left
+        pa = numpy.abs(p - left)
+        pb = numpy.abs(p - above)
+        pc = numpy.abs(p - upper_left)
+        predicted = numpy.where((pa <= pb) & (pa <= pc), left,
+                                numpy.where(pb <= pc, above, upper_left))
+    filtered = ((raw - predicted) & 0xff).astype(numpy.uint8)
+    types = numpy.full((len(rows), 1), filter_type, dtype=numpy.uint8)
+    return numpy.hstack((types, filtered)).tobytes()
+
+
+def make_png(width, height, bit_depth, color_type, filter_type,
+             palette_size=None):
+    channels = CHANNELS[color_type]
+    filter_unit = max(1, channels * bit_depth // 8)
+    random = numpy.random.default_rng(width * height + bit_depth)
+    band_height = max(1, BAND_SAMPLES // (width * channels))
+    compressor = zlib.compressobj()
+    pieces = []
+    previous = None
+    for y0 in range(0, height, band_height):
+        y1 = min(height, y0 + band_height)
+        rows = pack_samples(make_samples(width, height, channels, bit_depth,
+                                         palette_size, random, y0, y1),
+                            bit_depth)
+        pieces.append(compressor.compress(
+            filter_scanlines(rows, filter_type, filter_unit, previous)))
+        previous = rows[-1]
+    pieces.append(compressor.flush())
+    data = b''.join(pieces)
+
+    png = bytes(png_reader.PNG_SIGNATURE)
+    png += make_chunk(b'IHDR', struct.pack(
+        '!LLBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+    if palette_size:
+        colors = numpy.arange(palette_size * 3) * 97 % 256
+        png += make_chunk(b'PLTE', colors.astype(numpy.uint8).tobytes())
+    for start in range(0, len(data), IDAT_SIZE):
+        png += make_chunk(b'IDAT', data[start:start + IDAT_SIZE])
+    return png + make_chunk(b'IEND', b'')
+
+
+def get_cases(sizes, color_types, bit_depths, filter_types):
+    for size, color_type, filter_type in itertools.product(
+            sizes, color_types, filter_types):
+        for bit_depth in png_reader.COLOUR_TYPES[color_type][1]:
+            if bit_depths and bit_depth not in bit_depths:
+                continue
+            palette_sizes = sorted({min(p, 2 ** bit_depth)
+                                    for p in PALETTE_SIZES}) \
+                if color_type == 3 else [None]
+            for palette_size in palette_sizes:
+                yield size, color_type, bit_depth, filter_type, palette_size
+
+
+def get_case_name(size, color_type, bit_depth, filter_type, palette_size):
+    name = '{} type {} depth {} {}'.format(
+        size, color_type, bit_depth, FILTER_NAMES[filter_type])
+    if palette_size:
+        name += ' palette {}'.format(palette_size)
+    return name
+
+
+def run_stages(file_name):
+    """Decodes a file stage by stage, yielding the name of every stage
+    when it is finished"""
+    reader = png_reader.Reader(file_name, without_decoding=True)
+    yield 'read'
+
+    data = bytearray()
+    for piece in reader._inflate():
+        data += piece
+    yield 'inflate'
+
+    image_bytes = memoryview(reader._undo_filter(data))
+    yield 'unfilter'
+
+    reader.image.get_image(
+        image_bytes[i:i + reader.row_bytes]
+        for i in range(0, len(image_bytes), reader.row_bytes))
+    yield 'unpack'
+
+    reader.image.rgb_representation()
+    yield 'rgb'
+
+
+def measure(file_name, repeat):
+    """Returns {stage: {'mb_per_s': ..., 'peak_mb': ...}}.
+
+    Speed of every stage is given in megabytes of reconstructed scanlines
+    per second, the best of repeat runs. Peak memory is measured in a
+    separate run, because tracing allocations slows Python code down.
+    """
+    header = png_reader.Probe(file_name).header
+    channels = CHANNELS[header.color_type]
+    image_mb = header.height * -(-header.width * channels *
+                                 header.bit_depth // 8) / 2 ** 20
+
+    times = {stage: float('inf') for stage in STAGES}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for stage in run_stages(file_name):
+            end = time.perf_counter()
+            times[stage] = min(times[stage], end - start)
+            start = time.perf_counter()
+
+    peaks = {}
+    tracemalloc.start()
+    try:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for stage in run_stages(file_name):
+            current_now, peak = tracemalloc.get_traced_memory()
+            peaks[stage] = peak - current
+            current = current_now
+            tracemalloc.reset_peak()
+    finally:
+        tracemalloc.stop()
+
+    return {stage: {'mb_per_s': round(image_mb / max(times[stage], 1e-9),
+                                      2),
+                    'peak_mb': round(peaks[stage] / 2 ** 20, 2)}
+            for stage in STAGES}
+
+
+def measure_pipeline(file_name, repeat):
+    """Returns the best wall times of serial and pipelined decoding"""
+    times = []
+    for pipelined in (False, True):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            png_reader.Reader(file_name, pipelined=pipelined)
+            best = min(best, time.perf_counter() - start)
+        times.append(best)
+    return times
+
+
+def compare(results, baseline, threshold):
+    """Prints speed changes against a baseline, returns regression count"""
+    regressions = 0
+    for name, stages in results.items():
+        if name not in baseline:
+            continue
+        changes = []
+        for stage in STAGES:
+            old = baseline[name][stage]['mb_per_s']
+            new = stages[stage]['mb_per_s']
+            change = (new - old) / old * 100 if old else 0
+            mark = ''
+            if change < -threshold:
+                mark = ' REGRESSION'
+                regressions += 1
+            changes.append('{} {:+.1f}%{}'.format(stage, change, mark))
+        print('{}: {}'.format(name, ', '.join(changes)))
+    return regressions
+
+
+def print_result(name, result):
+    print('{}: {}'.format(name, ', '.join(
+        '{} {:.1f} MB/s {:.1f} MB'.format(
+            stage, result[stage]['mb_per_s'], result[stage]['peak_mb'])
+        for stage in STAGES)))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Decodes generated PNG images and reports the speed '
+                    'and peak memory of every decoding stage')
+    parser.add_argument('-s', '--sizes', nargs='+', choices=list(SIZES),
+                        default=['thumb', 'vga'], help='image sizes')
+    parser.add_argument('-t', '--color-types', nargs='+', type=int,
+                        choices=list(png_reader.COLOUR_TYPES),
+                        default=list(png_reader.COLOUR_TYPES),
+                        dest='color_types', help='colour types')
+    parser.add_argument('-d', '--bit-depths', nargs='+', type=int,
+                        choices=[1, 2, 4, 8, 16], dest='bit_depths',
+                        help='bit depths (all that suit a colour type '
+                             'by default)')
+    parser.add_argument('-f', '--filters', nargs='+', choices=FILTER_NAMES,
+                        default=list(FILTER_NAMES), help='filter types')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs to take the best time of')
+    parser.add_argument('--no-numpy', action='store_true', dest='no_numpy',
+                        help='decode without NumPy')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='compare the wall time of serial and '
+                             'pipelined decoding instead')
+    parser.add_argument('--save', help='save the results to a JSON file')
+    parser.add_argument('--compare',
+                        help='compare with results saved by --save')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='slowdown in percent reported as a regression')
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if numpy is None:
+        parser.error('NumPy is needed to generate the images')
+    if args.no_numpy:
+        filters.numpy = None
+        image.numpy = None
+
+    if args.pipeline and not pipeline.is_available():
+        print('{} CPU: pipelined decoding falls back to serial decoding'
+              .format(os.cpu_count()))
+
+    cases = get_cases(args.sizes,
+                      args.color_types, args.bit_depths,
+                      [FILTER_NAMES.index(name) for name in args.filters])
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = os.path.join(temp_dir, 'benchmark.png')
+        for size, color_type, bit_depth, filter_type, palette_size in cases:
+            with open(file_name, 'wb') as f:
+                f.write(make_png(*SIZES[size], bit_depth, color_type,
+                                 filter_type, palette_size))
+            name = get_case_name(size, color_type, bit_depth, filter_type,
+                                 palette_size)
+            if args.pipeline:
+                serial, pipelined = measure_pipeline(file_name, args.repeat)
+                print('{}: serial {:.1f} ms, pipelined {:.1f} ms, '
+                      'speedup {:.2f}x'.format(name, serial * 1000,
+                                              pipelined * 1000,
+                                              serial / pipelined))
+                continue
+            results[name] = measure(file_name, args.repeat)
+            print_result(name, results[name])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
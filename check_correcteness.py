@@ -1,7 +1,8 @@
 import argparse
-import os
-import re
 import subprocess
+import sys
+import time
+from png_viewer import batch
 
 
 CORRECT_ERRORS_PREFIXES = [
@@ -16,48 +17,85 @@ CORRECT_ERRORS_PREFIXES = [
     'Incorrect']
 
 
-def check_pics(path, call):
-    file_list = []
-    for dirname, dirs, files in os.walk(path):
-        file_list = [os.path.join(dirname, file)
-                     for file in files if re.match(r'.+\.png', file)]
+def is_correct_error(message):
+    return any(message.find(s, 0) != -1 for s in CORRECT_ERRORS_PREFIXES)
 
-    error_count = 0
+
+def check_pics(path, call=None, jobs=None):
+    """Decodes every png file under path and counts unexpected errors.
+
+    Files are decoded in worker processes of this interpreter unless
+    call, an external command to run for each file, is given.
+    """
+    file_list = batch.find_files([path])
     file_count = len(file_list)
+    error_count = 0
+    decode_time = 0
+    slowest = None
+    start = time.perf_counter()
 
-    for i, file in enumerate(file_list):
-        print('{} / {}'.format(i + 1, file_count), end='\r')
-        command = call + ' "' + file + '"'
-        result = subprocess.run(command, shell=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                encoding='utf-8')
-        if result.returncode == 0:
-            continue
-        correct_error = False
-        print(file, result.stderr, end='')
-        for s in CORRECT_ERRORS_PREFIXES:
-            if result.stderr.find(s, 0) != -1:
-                correct_error = True
-        if not correct_error:
+    if call is None:
+        records = batch.decode_files(file_list, jobs)
+    else:
+        records = map(lambda file: run_call(call, file), file_list)
+
+    for i, record in enumerate(records):
+        decode_time += record['time']
+        if slowest is None or record['time'] > slowest['time']:
+            slowest = record
+        error = record['error']
+        if error is None:
+            status = 'ok'
+        elif is_correct_error(error):
+            status = 'expected error: {}'.format(error)
+        else:
+            status = 'UNEXPECTED ERROR: {}'.format(error)
             error_count += 1
-            print(result.stderr, end='')
+        print('{} / {} {} {:.4f}s {}'.format(
+            i + 1, file_count, record['file'], record['time'], status))
+
     print('error count: {} / {}'.format(error_count, file_count))
+    if file_count:
+        print('decode time: {:.3f}s total, {:.4f}s mean, '
+              'slowest {} ({:.4f}s)'.format(
+                  decode_time, decode_time / file_count,
+                  slowest['file'], slowest['time']))
+    print('wall time: {:.3f}s'.format(time.perf_counter() - start))
+    return error_count
+
+
+def run_call(call, file):
+    start = time.perf_counter()
+    command = call + ' "' + file + '"'
+    result = subprocess.run(command, shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            encoding='utf-8')
+    error = None
+    if result.returncode != 0:
+        error = result.stderr.strip() or \
+            'exit code {}'.format(result.returncode)
+    return {'file': file, 'time': time.perf_counter() - start,
+            'error': error}
 
 
 def get_parser():
     parser = argparse.ArgumentParser(
-        description='Calls png reader on test pics')
+        description='Decodes test pics and counts unexpected errors')
     parser.add_argument('path', help='test pics directory')
-    parser.add_argument('call', help='function to call without filename')
+    parser.add_argument('call', nargs='?',
+                        help='command to call without filename instead of '
+                             'decoding in this process')
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs',
+                        help='number of worker processes '
+                             '(number of CPUs by default)')
     return parser.parse_args()
 
 
 def main():
     args = get_parser()
-    path = args.path
-    call = args.call
-    check_pics(path, call)
+    error_count = check_pics(args.path, args.call, args.jobs)
+    sys.exit(1 if error_count else 0)
 
 
 if __name__ == '__main__':
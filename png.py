@@ -1,5 +1,10 @@
 import argparse
-from png_viewer import png_reader, png_window
+import cProfile
+import functools
+import sys
+import tracemalloc
+from png_viewer import png_reader, batch, stats, disk_cache
+from png_viewer.errors import PNGError
 
 
 def get_parser():
@@ -13,38 +18,180 @@ def get_parser():
     parser.add_argument(
         '-v', '--visual', action='store_true', dest='visual_mode',
         help='show file visualisation (at least one mode should be chosen)')
-    parser.add_argument('file_name', help='png file name')
+    parser.add_argument(
+        '-p', '--probe', action='store_true', dest='probe_mode',
+        help='read only the signature and header without checking '
+             'other chunks (console modes 0 and 1 only)')
+    parser.add_argument(
+        '-b', '--batch', action='store_true', dest='batch_mode',
+        help='decode every given file, directory or glob and print '
+             'a JSON line per file')
+    parser.add_argument(
+        '-j', '--jobs', type=int, dest='jobs',
+        help='number of worker processes in batch mode '
+             '(number of CPUs by default)')
+    parser.add_argument(
+        '--profile', action='store_true', dest='profile_mode',
+        help='decode the file and print the time, bytes and allocations '
+             'of every decoding stage')
+    parser.add_argument(
+        '--profile-memory', action='store_true', dest='profile_memory',
+        help='trace allocations in profile mode (this slows decoding down)')
+    parser.add_argument(
+        '--profile-dump', dest='profile_dump', metavar='FILE',
+        help='save cProfile statistics of decoding to a pstats file')
+    parser.add_argument(
+        '--disk-cache', nargs='?', const=disk_cache.DEFAULT_DIRECTORY,
+        dest='cache_directory', metavar='DIRECTORY',
+        help='load decoded pixels from a cache directory if the file has '
+             'not changed and save them there otherwise '
+             '(default: {})'.format(disk_cache.DEFAULT_DIRECTORY))
+    parser.add_argument(
+        '--disk-cache-size', type=int,
+        default=disk_cache.DEFAULT_MAX_SIZE // 2 ** 20,
+        dest='cache_size', metavar='MB',
+        help='size limit of the disk cache in megabytes')
+    parser.add_argument(
+        '--region', nargs=4, type=int, dest='region',
+        metavar=('X0', 'Y0', 'X1', 'Y1'),
+        help='decode only columns X0..X1 and rows Y0..Y1 (ends excluded) '
+             'for console mode 2 and the viewer')
+    parser.add_argument(
+        '--pipelined', action='store_true', dest='pipelined',
+        help='check CRCs, inflate and unfilter in overlapping threads '
+             '(on more than one CPU)')
+    parser.add_argument(
+        '--integrity', choices=png_reader.INTEGRITY_LEVELS, default='full',
+        dest='integrity',
+        help='check CRCs of all chunks, of critical chunks only, of all '
+             'chunks on a background thread, or of none')
+    parser.add_argument('file_names', nargs='+', metavar='file_name',
+                        help='png file name (several in batch mode), '
+                             '- to read standard input')
     return parser
 
 
+def print_header(header, console_mode):
+    info = header.get_info() if not console_mode \
+        else header.get_detailed_info()
+    for i in info:
+        print('{}: {}'.format(*i))
+
+
+def profile(file_name, trace_memory=False, dump_file=None, cache=None,
+            pipelined=False, integrity='full'):
+    """Decodes a file, prints its stage breakdown and returns the reader"""
+    decode_stats = stats.DecodeStats()
+    profiler = cProfile.Profile() if dump_file else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        png = png_reader.Reader(file_name, stats=decode_stats, cache=cache,
+                                pipelined=pipelined, integrity=integrity)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(dump_file)
+        if trace_memory:
+            tracemalloc.stop()
+    for line in decode_stats.get_report():
+        print(line)
+    return png
+
+
 def main():
     parser = get_parser()
     args = parser.parse_args()
-    file_name = args.file_name
     console_mode = args.console_mode
     visual_mode = args.visual_mode
+    probe_mode = args.probe_mode
 
-    if console_mode is None and not visual_mode:
+    if args.batch_mode:
+        if console_mode is not None or visual_mode or probe_mode:
+            parser.error('Batch mode can not be combined with other modes')
+        if args.jobs is not None and args.jobs < 1:
+            parser.error('Number of jobs should be positive')
+        failures = batch.run(args.file_names, args.jobs)
+        sys.exit(1 if failures else 0)
+
+    if len(args.file_names) > 1:
+        parser.error('Several files can be given only in batch mode')
+    file_name = args.file_names[0]
+    if file_name == '-':
+        file_name = sys.stdin.buffer
+
+    cache = None
+    if args.cache_directory is not None:
+        if file_name is sys.stdin.buffer:
+            parser.error('The disk cache can not be used with standard input')
+        cache = disk_cache.DiskCache(args.cache_directory,
+                                     args.cache_size * 2 ** 20)
+
+    if args.profile_memory or args.profile_dump:
+        args.profile_mode = True
+    if args.region is not None and (args.profile_mode or cache is not None):
+        parser.error('Region can not be combined with profile mode '
+                     'or the disk cache')
+    if args.profile_mode:
+        if probe_mode:
+            parser.error('Probe mode can not be combined with profile mode')
+        png = profile(file_name, args.profile_memory, args.profile_dump,
+                      cache, args.pipelined, args.integrity)
+    elif console_mode is None and not visual_mode:
         parser.error('At least one mode should be chosen')
 
-    png = png_reader.Reader(
-        file_name, console_mode in (0, 1) and not visual_mode)
+    if probe_mode:
+        if console_mode not in (0, 1) or visual_mode:
+            parser.error('Probe mode works only with console modes 0 and 1')
+        png = png_reader.Probe(file_name)
+        print_header(png.header, console_mode)
+        return
+
+    if visual_mode and console_mode is None and cache is None and \
+            args.region is None and not args.profile_mode:
+        # the window opens before the file is read: the reader is created
+        # on the decoding thread, reading a stream only up to the first
+        # IDAT chunk, and the checksums of the image data are checked
+        # while its rows are shown
+        from png_viewer import png_window
+        integrity = 'deferred' if args.integrity == 'full' \
+            else args.integrity
+        png_window.show_window(open_reader=functools.partial(
+            png_reader.Reader, file_name, True, integrity=integrity,
+            lazy=True))
+        return
+
+    if not args.profile_mode:
+        # the viewer decodes in the background while showing the rows,
+        # unless the pixels are loaded from or saved to the disk cache
+        decoding = console_mode == 2 or (visual_mode and cache is not None)
+        png = png_reader.Reader(
+            file_name, not decoding or args.region is not None, cache=cache,
+            pipelined=args.pipelined, integrity=args.integrity)
+        if args.region is not None:
+            png.image = png.decode_region(*args.region)
 
     if console_mode is not None:
-        info = png.header.get_info() if not console_mode \
-            else png.header.get_detailed_info()
-        for i in info:
-            print('{}: {}'.format(*i))
+        # nothing else overlaps the deferred CRC check here
+        png.finish_crc_check()
+        print_header(png.header, console_mode)
+        if png.animation is not None:
+            print('Animation frames: {}'.format(len(png.animation)))
         if console_mode == 2:
-            print(png.image.rgb_representation())
-            print([tuple(pixel.tolist())
-                   for line in png.image.rgb_representation()
-                   for pixel in line])
+            rgb_map = png.image.rgb_representation()
+            print(rgb_map)
+            print([tuple(pixel) for line in rgb_map for pixel in line])
 
     if visual_mode:
-        png_window.show_window(
-            png.image.rgb_representation(), png.image.header)
+        # PyQt is loaded only when the window is shown
+        from png_viewer import png_window
+        png_window.show_window(png.image, animation=png.animation)
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except PNGError as e:
+        sys.exit(str(e))
@@ -0,0 +1,255 @@
+import struct
+import threading
+import collections
+from .errors import PNGError
+from .lru_cache import LRUCache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# default budget of composited frames kept in memory in bytes
+FRAME_CACHE_SIZE = 64 * 2 ** 20
+
+DISPOSE_NONE = 0
+DISPOSE_BACKGROUND = 1
+DISPOSE_PREVIOUS = 2
+
+BLEND_SOURCE = 0
+BLEND_OVER = 1
+
+FrameControl = collections.namedtuple(
+    'FrameControl', ['sequence_number', 'width', 'height', 'x_offset',
+                     'y_offset', 'delay_num', 'delay_den', 'dispose_op',
+                     'blend_op'])
+
+# a composited frame: RGBA pixels of the whole canvas shown for delay
+# seconds
+Frame = collections.namedtuple(
+    'Frame', ['index', 'width', 'height', 'pixels', 'delay'])
+
+
+def get_delay(control):
+    """Returns the delay of a frame in seconds"""
+    # a zero denominator means hundredths of a second
+    return control.delay_num / (control.delay_den or 100)
+
+
+class FrameCache(LRUCache):
+    """LRU cache of composited frames keyed by their index"""
+
+    def __init__(self, max_size=FRAME_CACHE_SIZE):
+        super().__init__(max_size)
+
+    def get_size(self, frame):
+        return len(frame.pixels)
+
+
+class Animation:
+    """Frames of an APNG file indexed from its acTL, fcTL and fdAT chunks.
+
+    Nothing is decoded when the animation is indexed. get_frame() decodes
+    frames in order up to the one asked for, applying the blend and
+    dispose operations of every frame to a canvas, and keeps composited
+    frames in a FrameCache, so playback decodes one frame per step.
+    Going back starts from the nearest cached frame that can be continued
+    from, or from the first frame.
+    """
+
+    def __init__(self, reader, num_frames, num_plays,
+                 cache_size=FRAME_CACHE_SIZE):
+        self.reader = reader
+        self.width = reader.header.width
+        self.height = reader.header.height
+        self.num_plays = num_plays
+        # (FrameControl, list of zlib data pieces) of every frame
+        self.frames = []
+        # whether the default image is the first frame
+        self.default_frame = False
+        self.cache = FrameCache(cache_size)
+        self._index_frames(reader.chunks_list)
+        if len(self.frames) != num_frames or not num_frames:
+            raise PNGError('Incorrect number of APNG frames: {} of {}'.format(
+                len(self.frames), num_frames))
+        self._lock = threading.RLock()
+        # the canvas before frame _next_index, allocated on first use
+        self._canvas = None
+        self._next_index = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _index_frames(self, chunks):
+        sequence_number = 0
+        idat_seen = False
+        for chunk_type, data in chunks:
+            if chunk_type == b'IDAT':
+                if not idat_seen and self.frames:
+                    if self.frames[0][1]:
+                        raise PNGError('Incorrect fdAT chunk position')
+                    self.default_frame = True
+                if self.default_frame:
+                    self.frames[0][1].append(data)
+                idat_seen = True
+            elif chunk_type not in (b'fcTL', b'fdAT'):
+                continue
+            elif len(data) < 4 or struct.unpack_from('!L', data)[0] != \
+                    sequence_number:
+                raise PNGError('Incorrect APNG sequence number in {} chunk'
+                               .format(chunk_type))
+            elif chunk_type == b'fcTL':
+                self.frames.append((self._read_control(data, idat_seen), []))
+                sequence_number += 1
+            else:
+                if not self.frames or \
+                        self.default_frame and len(self.frames) == 1:
+                    raise PNGError('Incorrect fdAT chunk position')
+                self.frames[-1][1].append(data[4:])
+                sequence_number += 1
+        for control, data in self.frames:
+            if not data:
+                raise PNGError('Incorrect APNG frame {} without data'.format(
+                    control.sequence_number))
+
+    def _read_control(self, data, idat_seen):
+        if len(data) != 26:
+            raise PNGError('Incorrect fcTL chunk length')
+        control = FrameControl(*struct.unpack('!LLLLLHHBB', data))
+        if not control.width or not control.height or \
+                control.x_offset + control.width > self.width or \
+                control.y_offset + control.height > self.height:
+            raise PNGError('Incorrect fcTL frame region')
+        if control.dispose_op > DISPOSE_PREVIOUS or \
+                control.blend_op > BLEND_OVER:
+            raise PNGError('Incorrect fcTL dispose or blend operation')
+        if not self.frames and not idat_seen and (
+                control.x_offset or control.y_offset or
+                (control.width, control.height) != (self.width, self.height)):
+            raise PNGError('Incorrect fcTL region of the default image')
+        return control
+
+    def get_frame(self, index):
+        """Returns the composited Frame of the given index"""
+        if not 0 <= index < len(self.frames):
+            raise IndexError('Frame index out of range: {}'.format(index))
+        with self._lock:
+            frame = self.cache.get(index)
+            if frame is not None:
+                return frame
+            if self._canvas is None or index < self._next_index:
+                self._rewind(index)
+            while True:
+                frame = self._compose_next()
+                if frame.index == index:
+                    return frame
+
+    def _rewind(self, index):
+        """Moves the canvas to the state before frame index or earlier"""
+        for previous in range(index - 1, -1, -1):
+            frame = self.cache.peek(previous)
+            control = self.frames[previous][0]
+            if frame is not None and control.dispose_op != DISPOSE_PREVIOUS:
+                self._canvas = bytearray(frame.pixels)
+                if control.dispose_op == DISPOSE_BACKGROUND:
+                    self._clear(control)
+                self._next_index = previous + 1
+                return
+        # the canvas starts fully transparent black
+        self._canvas = bytearray(self.width * self.height * 4)
+        self._next_index = 0
+
+    def _compose_next(self):
+        index = self._next_index
+        control, data = self.frames[index]
+        saved = None
+        if control.dispose_op == DISPOSE_PREVIOUS:
+            saved = self._get_region(control)
+        rgba = self._decode(control, data)
+        if control.blend_op == BLEND_SOURCE:
+            self._set_region(control, rgba)
+        else:
+            self._blend_over(control, rgba)
+        frame = Frame(index, self.width, self.height, bytes(self._canvas),
+                      get_delay(control))
+        self.cache.put(index, frame)
+        if control.dispose_op == DISPOSE_BACKGROUND:
+            self._clear(control)
+        elif saved is not None:
+            self._set_region(control, saved)
+        self._next_index = (index + 1) % len(self.frames)
+        if not self._next_index:
+            # playing again starts from a new canvas
+            self._canvas = None
+        return frame
+
+    def _decode(self, control, data):
+        """Returns the RGBA pixels of a frame region"""
+        frame_image = self.reader.decode_frame(
+            control.width, control.height, data)
+        pixels, channels = frame_image.get_display_pixels()
+        pixels = bytes(pixels)
+        if channels == 4:
+            return pixels
+        rgba = bytearray(b'\xff') * (len(pixels) // channels * 4)
+        for i in range(3):
+            rgba[i::4] = pixels[i % channels::channels]
+        return rgba
+
+    def _get_rows(self, control):
+        """Yields (canvas slice, region slice) of every region row"""
+        row_size = control.width * 4
+        for y in range(control.height):
+            start = ((control.y_offset + y) * self.width +
+                     control.x_offset) * 4
+            yield (slice(start, start + row_size),
+                   slice(y * row_size, (y + 1) * row_size))
+
+    def _get_region(self, control):
+        region = bytearray(control.width * control.height * 4)
+        for canvas_row, region_row in self._get_rows(control):
+            region[region_row] = self._canvas[canvas_row]
+        return region
+
+    def _set_region(self, control, rgba):
+        for canvas_row, region_row in self._get_rows(control):
+            self._canvas[canvas_row] = rgba[region_row]
+
+    def _clear(self, control):
+        self._set_region(control, bytes(control.width * control.height * 4))
+
+    def _blend_over(self, control, rgba):
+        """Composites non-premultiplied RGBA pixels over the canvas"""
+        if numpy is not None:
+            canvas = numpy.frombuffer(self._canvas, dtype=numpy.uint8)
+            dst = canvas.reshape(self.height, self.width, 4)[
+                control.y_offset:control.y_offset + control.height,
+                control.x_offset:control.x_offset + control.width]
+            src = numpy.frombuffer(rgba, dtype=numpy.uint8).reshape(
+                control.height, control.width, 4).astype(numpy.float64)
+            old = dst.astype(numpy.float64)
+            src_alpha = src[..., 3:] / 255
+            dst_alpha = old[..., 3:] / 255 * (1 - src_alpha)
+            alpha = src_alpha + dst_alpha
+            color = (src[..., :3] * src_alpha + old[..., :3] * dst_alpha) / \
+                numpy.maximum(alpha, 1e-12)
+            dst[..., :3] = numpy.rint(color)
+            dst[..., 3:] = numpy.rint(alpha * 255)
+            return
+
+        canvas = self._canvas
+        for canvas_row, region_row in self._get_rows(control):
+            start = canvas_row.start
+            for i in range(region_row.start, region_row.stop, 4):
+                src_alpha = rgba[i + 3]
+                if src_alpha == 255:
+                    canvas[start:start + 4] = rgba[i:i + 4]
+                elif src_alpha:
+                    dst_alpha = canvas[start + 3] * (255 - src_alpha) / 255
+                    alpha = src_alpha + dst_alpha
+                    for k in range(3):
+                        canvas[start + k] = round(
+                            (rgba[i + k] * src_alpha +
+                             canvas[start + k] * dst_alpha) / alpha)
+                    canvas[start + 3] = round(alpha)
+                start += 4
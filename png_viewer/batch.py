@@ -0,0 +1,64 @@
+import os
+import glob
+import json
+import time
+import multiprocessing
+from . import png_reader
+from .errors import PNGError
+
+
+def find_files(patterns):
+    """Expands file names, directories and glob patterns to file names.
+
+    Directories are searched recursively for .png files. Names that
+    match nothing are kept, so that their error shows up in the output.
+    """
+    file_names = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for dirname, dirs, files in os.walk(pattern):
+                dirs.sort()
+                file_names.extend(os.path.join(dirname, file)
+                                  for file in sorted(files)
+                                  if file.lower().endswith('.png'))
+        elif glob.has_magic(pattern):
+            file_names.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            file_names.append(pattern)
+    return file_names
+
+
+def decode_file(file_name):
+    """Decodes one file and returns its record, never raising"""
+    record = {'file': file_name, 'header': None, 'time': None,
+              'error': None}
+    start = time.perf_counter()
+    try:
+        reader = png_reader.Reader(file_name)
+        record['header'] = dict(vars(reader.header))
+    except PNGError as e:
+        record['error'] = str(e)
+    except Exception as e:
+        # unreadable files and damaged data other checks let through
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    record['time'] = round(time.perf_counter() - start, 6)
+    return record
+
+
+def decode_files(file_names, jobs=None):
+    """Yields records of decoded files in order, using jobs processes"""
+    if jobs == 1 or len(file_names) < 2:
+        yield from map(decode_file, file_names)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap(decode_file, file_names)
+
+
+def run(patterns, jobs=None, output=None):
+    """Writes one JSON line per file and returns the number of failures"""
+    failures = 0
+    for record in decode_files(find_files(patterns), jobs):
+        if record['error'] is not None:
+            failures += 1
+        print(json.dumps(record), file=output, flush=True)
+    return failures
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import mmap
+import hashlib
+import tempfile
+from array import array
+
+DEFAULT_DIRECTORY = os.path.join(
+    os.path.expanduser('~'), '.cache', 'png_viewer')
+
+# default limit of the total size of cached pixels in bytes
+DEFAULT_MAX_SIZE = 2 ** 30
+
+PIXELS_SUFFIX = '.pixels'
+INFO_SUFFIX = '.json'
+
+
+class DiskCache:
+    """Decoded pixels of PNG files kept in a directory between runs.
+
+    An entry is keyed by the absolute path, size and modification time of
+    the file and by a hash of the CRCs of all its chunks, which the reader
+    has checked anyway, so a changed file never matches an old entry.
+    Pixels are stored raw in the native byte order next to a JSON file
+    with the header and are memory-mapped when loaded. Entries used least
+    recently are removed when the total size exceeds max_size.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY,
+                 max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, reader):
+        file_stat = os.stat(reader.file_name)
+        key = hashlib.sha1('{}\0{}\0{}\0{}'.format(
+            os.path.abspath(reader.file_name), file_stat.st_size,
+            file_stat.st_mtime_ns, reader.image.to_8bit).encode())
+        for chunk in reader.chunk_index:
+            key.update(chunk.type)
+            key.update(chunk.crc.to_bytes(4, 'big'))
+        return key.hexdigest()
+
+    def load(self, reader):
+        """Sets the pixels of the reader image from the cache.
+
+        Returns False if there is no matching entry.
+        """
+        path = os.path.join(self.directory, self.get_key(reader))
+        try:
+            with open(path + INFO_SUFFIX) as f:
+                info = json.load(f)
+            with open(path + PIXELS_SUFFIX, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if info != self._get_info(reader, size):
+                    raise ValueError('Cache entry does not match')
+                pixels = array(info['typecode'])
+                if size:
+                    with mmap.mmap(f.fileno(), 0,
+                                   access=mmap.ACCESS_READ) as data:
+                        pixels.frombytes(data)
+            # the modification time orders entries for eviction
+            os.utime(path + PIXELS_SUFFIX)
+        except (OSError, ValueError):
+            self.misses += 1
+            return False
+        reader.image.pixels = pixels
+        self.hits += 1
+        return True
+
+    def store(self, reader):
+        """Saves the pixels of the decoded reader image to the cache"""
+        pixels = reader.image.pixels
+        size = len(pixels) * pixels.itemsize
+        if size > self.max_size:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.get_key(reader))
+        # entries appear complete or not at all, and every writer has its
+        # own temporary files, so processes storing the same entry never
+        # mix their writes
+        pixels_temp = self._write_temp('wb', pixels.tofile)
+        try:
+            info_temp = self._write_temp('w', lambda f: json.dump(
+                self._get_info(reader, size), f))
+        except BaseException:
+            os.remove(pixels_temp)
+            raise
+        os.replace(info_temp, path + INFO_SUFFIX)
+        os.replace(pixels_temp, path + PIXELS_SUFFIX)
+        self.evict()
+
+    def _write_temp(self, mode, write):
+        """Calls write with a new temporary file, returns its path"""
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with open(fd, mode) as f:
+                write(f)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path
+
+    def evict(self):
+        """Removes least recently used entries above the size limit"""
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(PIXELS_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((file_stat.st_mtime_ns, path, file_stat.st_size))
+            total_size += file_stat.st_size
+        entries.sort()
+        while total_size > self.max_size and entries:
+            _, path, size = entries.pop(0)
+            for file_name in (path, path[:-len(PIXELS_SUFFIX)] + INFO_SUFFIX):
+                try:
+                    os.remove(file_name)
+                except OSError:
+                    pass
+            total_size -= size
+
+    def _get_info(self, reader, size):
+        info = dict(vars(reader.header))
+        info.update(typecode='H' if reader.image.bit_depth == 16 else 'B',
+                    byteorder=sys.byteorder, size=size)
+        return info
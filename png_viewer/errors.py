@@ -0,0 +1,15 @@
+import zlib
+import contextlib
+
+
+class PNGError(ValueError):
+    """Raised for a file that is not a correct PNG image"""
+
+
+@contextlib.contextmanager
+def zlib_errors():
+    """Raises PNGError for the zlib.error of corrupted IDAT data"""
+    try:
+        yield
+    except zlib.error as e:
+        raise PNGError('Incorrect zlib stream: {}'.format(e)) from e
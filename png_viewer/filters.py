@@ -0,0 +1,215 @@
+from .errors import PNGError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FILTER_TYPES = (0, 1, 2, 3, 4)
+
+
+class PythonEngine:
+    """Reconstructs filtered scanlines in pure Python.
+
+    Every scanline is copied into its place in one preallocated output
+    buffer and then reconstructed in place, reading the previous row from
+    the same buffer, so decoding time is linear in the image height.
+    """
+
+    def __init__(self, row_bytes, filter_unit):
+        self.row_bytes = row_bytes
+        self.filter_unit = filter_unit
+        self._zero_row = bytes(row_bytes)
+
+    def undo_filter(self, data, previous=None):
+        """Reconstructs whole filtered scanlines of data.
+
+        Previous is the reconstructed row above the first one, if any.
+        """
+        row_bytes = self.row_bytes
+        rows_count = len(data) // (row_bytes + 1)
+        result = bytearray(rows_count * row_bytes)
+        data = memoryview(data)
+
+        if previous is None:
+            previous = self._zero_row
+        previous_start = 0
+        for y in range(rows_count):
+            start = y * (row_bytes + 1)
+            out_start = y * row_bytes
+            result[out_start:out_start + row_bytes] = \
+                data[start + 1:start + 1 + row_bytes]
+            self._unfilter(data[start], result, out_start,
+                           previous, previous_start)
+            previous, previous_start = result, out_start
+        return result
+
+    def unfilter_row(self, filter_type, scanline, previous=None):
+        result = bytearray(scanline)
+        if previous is None:
+            previous = self._zero_row
+        self._unfilter(filter_type, result, 0, previous, 0)
+        return result
+
+    def _unfilter(self, filter_type, result, start, previous, previous_start):
+        if filter_type not in FILTER_TYPES:
+            raise PNGError('Unknown filter: {}'.format(filter_type))
+
+        unit = self.filter_unit
+        end = start + self.row_bytes
+        # offset from a byte in the result to the byte above it
+        above = previous_start - start
+
+        if filter_type == 1:
+            for i in range(start + unit, end):
+                result[i] = (result[i] + result[i - unit]) & 0xff
+        elif filter_type == 2:
+            for i in range(start, end):
+                result[i] = (result[i] + previous[i + above]) & 0xff
+        elif filter_type == 3:
+            for i in range(start, start + unit):
+                result[i] = (result[i] + (previous[i + above] >> 1)) & 0xff
+            for i in range(start + unit, end):
+                result[i] = (result[i] + (
+                    (result[i - unit] + previous[i + above]) >> 1)) & 0xff
+        elif filter_type == 4:
+            for i in range(start, start + unit):
+                result[i] = (result[i] + previous[i + above]) & 0xff
+            for i in range(start + unit, end):
+                a = result[i - unit]
+                b = previous[i + above]
+                c = previous[i + above - unit]
+                p = a + b - c
+                pa = abs(p - a)
+                pb = abs(p - b)
+                pc = abs(p - c)
+                if pa <= pb and pa <= pc:
+                    pr = a
+                elif pb <= pc:
+                    pr = b
+                else:
+                    pr = c
+                result[i] = (result[i] + pr) & 0xff
+
+
+class NumpyEngine:
+    """Reconstructs filtered scanlines with NumPy row operations.
+
+    Only None, Sub and Up are accelerated: None and Up are whole-row
+    vector operations and Sub is a cumulative sum over every
+    bytes-per-pixel lane. Average and Paeth depend on the already
+    reconstructed byte to the left through a rounding or a comparison,
+    which has no vector form, so their above-row terms are vectorised and
+    every lane is then reconstructed by a Python loop, at about the speed
+    of PythonEngine. Stepping NumPy operations over pixels is several
+    times slower than this loop.
+    """
+
+    def __init__(self, row_bytes, filter_unit):
+        self.row_bytes = row_bytes
+        self.filter_unit = filter_unit
+
+    def undo_filter(self, data, previous=None):
+        line_bytes = self.row_bytes + 1
+        rows_count = len(data) // line_bytes
+        filtered = numpy.frombuffer(
+            data, dtype=numpy.uint8,
+            count=rows_count * line_bytes).reshape(rows_count, line_bytes)
+        result = bytearray(rows_count * self.row_bytes)
+        result_rows = numpy.frombuffer(result, dtype=numpy.uint8).reshape(
+            rows_count, self.row_bytes)
+
+        if previous is None:
+            previous = numpy.zeros(self.row_bytes, dtype=numpy.uint8)
+        else:
+            previous = numpy.frombuffer(previous, dtype=numpy.uint8)
+        for y in range(rows_count):
+            self._unfilter(
+                filtered[y, 0], filtered[y, 1:], previous, result_rows[y])
+            previous = result_rows[y]
+        return result
+
+    def unfilter_row(self, filter_type, scanline, previous=None):
+        result = bytearray(self.row_bytes)
+        if previous is None:
+            previous = numpy.zeros(self.row_bytes, dtype=numpy.uint8)
+        else:
+            previous = numpy.frombuffer(previous, dtype=numpy.uint8)
+        self._unfilter(filter_type,
+                       numpy.frombuffer(scanline, dtype=numpy.uint8),
+                       previous,
+                       numpy.frombuffer(result, dtype=numpy.uint8))
+        return result
+
+    def _unfilter(self, filter_type, scanline, previous, out):
+        if filter_type not in FILTER_TYPES:
+            raise PNGError('Unknown filter: {}'.format(filter_type))
+
+        if filter_type == 0:
+            out[:] = scanline
+        elif filter_type == 1:
+            numpy.cumsum(scanline.reshape(-1, self.filter_unit), axis=0,
+                          dtype=numpy.uint8,
+                          out=out.reshape(-1, self.filter_unit))
+        elif filter_type == 2:
+            numpy.add(scanline, previous, out=out)
+        elif filter_type == 3:
+            out[:] = self._average(scanline, previous)
+        else:
+            out[:] = self._paeth(scanline, previous)
+
+    def _average(self, scanline, previous):
+        unit = self.filter_unit
+        result = numpy.empty_like(scanline)
+        # every bytes-per-pixel lane depends only on itself
+        for lane in range(unit):
+            left = 0
+            values = []
+            append = values.append
+            for x, b in zip(scanline[lane::unit].tolist(),
+                            previous[lane::unit].tolist()):
+                left = (x + ((left + b) >> 1)) & 0xff
+                append(left)
+            result[lane::unit] = values
+        return result
+
+    def _paeth(self, scanline, previous):
+        unit = self.filter_unit
+        if not previous.any():
+            # Paeth against an all-zero row always predicts the left byte
+            return numpy.cumsum(scanline.reshape(-1, unit), axis=0,
+                                dtype=numpy.uint8).reshape(-1)
+
+        above = previous.astype(numpy.int16)
+        upper_left = numpy.zeros_like(above)
+        upper_left[unit:] = above[:-unit]
+        # pa = |p - a| = |b - c| does not depend on the left byte
+        above_distance = numpy.abs(above - upper_left)
+
+        result = numpy.empty_like(scanline)
+        for lane in range(unit):
+            a = 0
+            values = []
+            append = values.append
+            for x, b, c, pa in zip(scanline[lane::unit].tolist(),
+                                   previous[lane::unit].tolist(),
+                                   upper_left[lane::unit].tolist(),
+                                   above_distance[lane::unit].tolist()):
+                pb = abs(a - c)
+                pc = abs(a + b - c - c)
+                if pa <= pb and pa <= pc:
+                    pr = a
+                elif pb <= pc:
+                    pr = b
+                else:
+                    pr = c
+                a = (x + pr) & 0xff
+                append(a)
+            result[lane::unit] = values
+        return result
+
+
+def get_engine(row_bytes, filter_unit):
+    if numpy is None:
+        return PythonEngine(row_bytes, filter_unit)
+    return NumpyEngine(row_bytes, filter_unit)
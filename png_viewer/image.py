@@ -1,49 +1,198 @@
-import struct
+import sys
 import math
+import operator
+import collections
 from array import array
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _get_sample_tables(bit_depth):
+    """For every sample position in a byte, maps a byte to that sample"""
+    mask = (1 << bit_depth) - 1
+    return [bytes((byte >> shift) & mask for byte in range(256))
+            for shift in range(8 - bit_depth, -1, -bit_depth)]
+
+
+SAMPLE_TABLES = {bit_depth: _get_sample_tables(bit_depth)
+                 for bit_depth in (1, 2, 4)}
+
 
 class Image:
-    def __init__(self, reader):
+    """Decoded samples of a PNG image in one contiguous buffer.
+
+    Row y occupies pixels[y * stride:(y + 1) * stride]. An image of a
+    region (x0, y0, x1, y1) holds only columns x0..x1 and rows y0..y1 of
+    the file, ends excluded, and get_image() takes only those rows.
+    """
+
+    def __init__(self, reader, to_8bit=False, region=None):
         self.reader = reader
         self.header = self.reader.header
         self.bit_depth = self.header.bit_depth
-        self.bit_map = []
+        # 16-bit samples are reduced to their high byte while decoding
+        self.to_8bit = to_8bit and self.bit_depth == 16
+        if self.to_8bit:
+            self.bit_depth = 8
+        self.width = self.header.width
+        self.height = self.header.height
+        self.channels = self.reader.total_samples_count
+        self.palette = self.reader.palette
+        self.palette_channels = self.reader.palette_channels
+        # columns of the scanlines given to get_image() that are kept
+        self.x0 = 0
+        self._crop = None
+        if region is not None:
+            x0, y0, x1, y1 = region
+            self.x0 = x0
+            self.width = x1 - x0
+            self.height = y1 - y0
+            if self.header.bit_depth >= 8:
+                sample_bytes = self.header.bit_depth // 8 * self.channels
+                self._crop = slice(x0 * sample_bytes, x1 * sample_bytes)
+        self.stride = self.width * self.channels
+        self.pixels = None
+
+    def detach(self):
+        """Drops the reader, so that its file data can be released.
+
+        The pixels stay usable but rows can not be decoded any more.
+        """
+        self.reader = None
 
     def get_image(self, image_rows_list):
+        self.pixels = array('H' if self.bit_depth == 16 else 'B')
         for row in image_rows_list:
-            pixels = self._get_pixels(row)
-            self.bit_map.append(pixels)
+            self.pixels.frombytes(self._get_pixels(row))
+        if self.bit_depth == 16 and sys.byteorder == 'little':
+            self.pixels.byteswap()
+
+    def get_row_samples(self, row):
+        """Returns the samples of one reconstructed scanline as an array"""
+        samples = array('H' if self.bit_depth == 16 else 'B')
+        samples.frombytes(self._get_pixels(row))
+        if self.bit_depth == 16 and sys.byteorder == 'little':
+            samples.byteswap()
+        return samples
+
+    def get_8bit_pixels(self):
+        """Returns the high bytes of 16-bit samples as an array"""
+        if self.bit_depth != 16:
+            return self.pixels
+        high_byte = 1 if sys.byteorder == 'little' else 0
+        return array(
+            'B', bytes(memoryview(self.pixels).cast('B')[high_byte::2]))
+
+    @property
+    def bit_map(self):
+        """Rows of samples as a list of arrays, built on every access"""
+        if self.pixels is None:
+            return []
+        return [self.pixels[i:i + self.stride]
+                for i in range(0, len(self.pixels), self.stride)]
+
+    def get_buffer(self):
+        return memoryview(self.pixels)
+
+    def __buffer__(self, flags):
+        return memoryview(self.pixels)
+
+    def as_array(self):
+        """Returns a (height, width, channels) NumPy view of the pixels"""
+        return numpy.frombuffer(self.pixels, dtype=numpy.dtype(
+            self.pixels.typecode)).reshape(-1, self.width, self.channels)
 
     def _get_pixels(self, pixel_line):
+        """Returns the samples of a row as bytes.
+
+        16-bit samples are returned in the big-endian order of the file.
+        """
         bit_depth = self.header.bit_depth
+        if bit_depth >= 8 and self._crop is not None:
+            pixel_line = pixel_line[self._crop]
         if bit_depth == 8:
             return pixel_line
         if bit_depth == 16:
-            pixel_line = array.tostring(pixel_line)
-            return array(
-                'H',
-                struct.unpack('!{}H'.format(len(pixel_line) // 2), pixel_line))
-
-        bit_array = array('B')
-        for byte in pixel_line:
-            bit_str = '{:08b}'.format(byte)
-            i = 0
-            while i < 8:
-                pix = bit_str[i:i + bit_depth]
-                bit_array.append(int(pix, 2))
-                i += bit_depth
-        return bit_array
+            if self.to_8bit:
+                return bytes(pixel_line[::2])
+            return pixel_line
+
+        # sub-byte depths have a single sample per pixel
+        tables = SAMPLE_TABLES[bit_depth]
+        per_byte = len(tables)
+        first_byte = self.x0 // per_byte
+        last_byte = -(-(self.x0 + self.width) // per_byte)
+        pixel_line = bytes(pixel_line[first_byte:last_byte])
+        samples = bytearray(len(pixel_line) * per_byte)
+        for i, table in enumerate(tables):
+            samples[i::per_byte] = pixel_line.translate(table)
+        start = self.x0 - first_byte * per_byte
+        del samples[start + self.width:]
+        del samples[:start]
+        return samples
 
     def rgb_representation(self):
         color_type = self.header.color_type
         return self.RGB_FUNCTIONS[color_type](self)
 
+    def expand_palette(self, indices=None):
+        """Returns the palette colours of pixels as RGB or RGBA bytes.
+
+        Indices default to all pixels of the image.
+        """
+        palette = self.palette
+        channels = self.palette_channels
+        if indices is None:
+            indices = self.pixels
+        indices = indices.tobytes()
+        colors = bytearray(len(indices) * channels)
+        for i in range(channels):
+            colors[i::channels] = indices.translate(palette[i::channels])
+        return colors
+
+    @property
+    def display_channels(self):
+        if self.header.color_type == 3:
+            return self.palette_channels
+        return {0: 1, 2: 3, 4: 4, 6: 4}[self.header.color_type]
+
+    def get_display_pixels(self, samples=None):
+        """Returns (pixels, channels) with grey, RGB or RGBA samples.
+
+        Samples default to all pixels of the image and may also be a part
+        of it, such as a row from get_row_samples(). They keep the image
+        bit depth except for sub-byte grey, which is scaled to 8 bits.
+        Indexed colours are looked up in the palette and grey with alpha
+        is expanded to RGBA.
+        """
+        if samples is None:
+            samples = self.pixels
+        color_type = self.header.color_type
+        if color_type == 3:
+            return self.expand_palette(samples), self.display_channels
+        if color_type == 0 and self.bit_depth < 8:
+            max_value = 2 ** self.bit_depth - 1
+            table = bytes(min(255, i * 255 // max_value) for i in range(256))
+            return samples.tobytes().translate(table), 1
+        if color_type == 4:
+            pixels = array(samples.typecode, [0]) * (len(samples) * 2)
+            for i in range(3):
+                pixels[i::4] = samples[0::2]
+            pixels[3::4] = samples[1::2]
+            return pixels, 4
+        return samples, self.display_channels
+
     def _get_indexed_color(self):
-        palette = self.reader.PLTE
+        channels = self.palette_channels
+        colors = bytes(self.expand_palette())
+        row_length = self.width * channels
         rgb_view = []
-        for line in self.bit_map:
-            rgb_line = [palette[i] for i in line]
+        for start in range(0, len(colors), row_length):
+            rgb_line = [colors[i:i + channels]
+                        for i in range(start, start + row_length, channels)]
             rgb_view.append(rgb_line)
         return rgb_view
 
@@ -98,3 +247,76 @@ class Image:
         4: _get_grayscale_with_alpha,
         6: _get_truecolor_with_alpha
     }
+
+
+Thumbnail = collections.namedtuple(
+    'Thumbnail', ['width', 'height', 'channels', 'pixels'])
+
+
+class BoxScaler:
+    """Averages rows of 8-bit pixels over factor by factor boxes.
+
+    Rows are added one at a time and only the sums for the current output
+    row are kept, so memory does not depend on the source height. Boxes
+    at the right and bottom edges may be smaller.
+    """
+
+    def __init__(self, width, height, channels, factor):
+        self.width = width
+        self.channels = channels
+        self.factor = factor
+        self.out_width = -(-width // factor)
+        self.out_height = -(-height // factor)
+        self.pixels = array('B')
+        # source columns averaged into every output column
+        self._column_counts = [factor] * (self.out_width - 1) + \
+            [width - (self.out_width - 1) * factor]
+        self._rows = 0
+        if numpy is not None:
+            self._starts = numpy.arange(0, width, factor)
+            self._sums = numpy.zeros(self.out_width * channels,
+                                     dtype=numpy.int64)
+        else:
+            self._sums = [[0] * self.out_width for _ in range(channels)]
+
+    def add_row(self, row):
+        """Adds a row of width * channels samples"""
+        channels = self.channels
+        if numpy is not None:
+            samples = numpy.frombuffer(row, dtype=numpy.uint8).reshape(
+                self.width, channels)
+            self._sums += numpy.add.reduceat(
+                samples, self._starts, axis=0, dtype=numpy.int64).reshape(-1)
+        else:
+            step = self.factor * channels
+            for c, sums in enumerate(self._sums):
+                for dx in range(self.factor):
+                    lane = row[dx * channels + c::step]
+                    sums[:len(lane)] = map(operator.add, sums, lane)
+        self._rows += 1
+        if self._rows == self.factor:
+            self._add_output_row()
+
+    def finish(self):
+        """Returns the pixels after the last row was added"""
+        if self._rows:
+            self._add_output_row()
+        return self.pixels
+
+    def _add_output_row(self):
+        channels = self.channels
+        if numpy is not None:
+            counts = numpy.repeat(numpy.array(self._column_counts) *
+                                  self._rows, channels)
+            averages = (self._sums + counts // 2) // counts
+            self.pixels.frombytes(averages.astype(numpy.uint8).tobytes())
+            self._sums[:] = 0
+        else:
+            output_row = array('B', [0]) * (self.out_width * channels)
+            for c, sums in enumerate(self._sums):
+                output_row[c::channels] = array('B', [
+                    (total + count * self._rows // 2) // (count * self._rows)
+                    for total, count in zip(sums, self._column_counts)])
+                sums[:] = [0] * self.out_width
+            self.pixels.extend(output_row)
+        self._rows = 0
@@ -0,0 +1,74 @@
+import os
+import threading
+from . import png_reader
+from .lru_cache import LRUCache
+
+# default budget of cached pixels in bytes
+DEFAULT_MAX_SIZE = 256 * 2 ** 20
+
+
+class ImageCache(LRUCache):
+    """LRU cache of decoded images limited by their total pixel bytes.
+
+    Images are keyed by the absolute path, size and modification time of
+    the file and by the requested output format (to_8bit), so a changed
+    file is decoded again. The cache may be shared between threads, so
+    every public method of the LRU cache holds a lock.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        super().__init__(max_size)
+        # put() calls discard()
+        self._lock = threading.RLock()
+
+    def get_size(self, png_image):
+        return get_image_size(png_image)
+
+    def get_image(self, file_name, to_8bit=False, **reader_args):
+        """Returns the decoded image of a file, decoding it on a miss.
+
+        Other keyword arguments are passed to png_reader.Reader.
+        """
+        key = self.get_key(file_name, to_8bit)
+        png_image = self.get(key)
+        if png_image is not None:
+            return png_image
+        reader = png_reader.Reader(file_name, to_8bit=to_8bit, **reader_args)
+        # cached images must not keep the file mapped
+        png_image = reader.image
+        png_image.detach()
+        reader.close()
+        self.put(key, png_image)
+        return png_image
+
+    def get_key(self, file_name, to_8bit=False):
+        file_stat = os.stat(file_name)
+        return (os.path.abspath(file_name), file_stat.st_size,
+                file_stat.st_mtime_ns, to_8bit)
+
+    def get(self, key):
+        with self._lock:
+            return super().get(key)
+
+    def peek(self, key):
+        with self._lock:
+            return super().peek(key)
+
+    def put(self, key, png_image):
+        with self._lock:
+            super().put(key, png_image)
+
+    def discard(self, key):
+        with self._lock:
+            super().discard(key)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+
+
+def get_image_size(png_image):
+    return len(png_image.pixels) * png_image.pixels.itemsize
+
+
+shared_cache = ImageCache()
@@ -0,0 +1,59 @@
+import collections
+
+
+class LRUCache:
+    """LRU cache of values limited by their total size in bytes.
+
+    Subclasses define get_size() for their values. A value larger than
+    the whole budget is not stored, unless keep_last is set, in which
+    case the most recent value is always kept.
+    """
+
+    def __init__(self, max_size, keep_last=False):
+        self.max_size = max_size
+        self.keep_last = keep_last
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def get_size(self, value):
+        return len(value)
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def peek(self, key):
+        """Returns a cached value without counting or reordering it"""
+        return self._entries.get(key)
+
+    def put(self, key, value):
+        size = self.get_size(value)
+        # an older value of the key must not outlive a newer one
+        self.discard(key)
+        if size > self.max_size and not self.keep_last:
+            return
+        self._entries[key] = value
+        self.size += size
+        while self.size > self.max_size and len(self._entries) > 1:
+            _, old_value = self._entries.popitem(last=False)
+            self.size -= self.get_size(old_value)
+            self.evictions += 1
+
+    def discard(self, key):
+        if key in self._entries:
+            self.size -= self.get_size(self._entries.pop(key))
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
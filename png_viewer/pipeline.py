@@ -0,0 +1,184 @@
+import os
+import time
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from .errors import zlib_errors
+
+# pieces of data waiting between two stages
+QUEUE_SIZE = 8
+# upper bound for one piece of compressed input and of inflated output
+PIECE_SIZE = 2 ** 18
+# inflated data passed on and unfiltered at a time
+BATCH_SIZE = 2 ** 20
+# the stages only overlap on more than one CPU
+MIN_CPU_COUNT = 2
+# seconds between checks whether another stage has failed
+WAIT_INTERVAL = 0.1
+
+_END = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def is_available():
+    """Whether the stages can run at the same time on this machine"""
+    return (os.cpu_count() or 1) >= MIN_CPU_COUNT
+
+
+class Pipeline:
+    """Decodes the IDAT data of a reader in three overlapping stages.
+
+    One pool thread checks the CRCs of IDAT chunks, another inflates the
+    checked chunks, and the calling thread unfilters the inflated rows.
+    The stages are connected by bounded queues, so memory stays limited
+    while zlib.crc32 and decompression, which release the GIL, run at
+    the same time as unfiltering. An error in any stage stops the others
+    and is raised from run().
+    """
+
+    def __init__(self, reader, idat_chunks):
+        # (chunk number, ChunkInfo, whether to check the CRC) of IDAT
+        # chunks
+        self.reader = reader
+        self.idat_chunks = idat_chunks
+        self._checked = queue.Queue(QUEUE_SIZE)
+        self._inflated = queue.Queue(QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._error = None
+
+    def run(self):
+        """Returns the reconstructed scanlines"""
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            pool.submit(self._run_stage, self._check_chunks, self._checked)
+            pool.submit(self._run_stage, self._inflate, self._inflated)
+            try:
+                return self._undo_filter()
+            except _Stopped:
+                raise self._error
+            except BaseException:
+                self._stop.set()
+                raise
+
+    def _run_stage(self, stage, output):
+        try:
+            stage()
+            self._put(output, _END)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._error = e
+            self._stop.set()
+
+    def _get(self, source):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped
+            try:
+                return source.get(timeout=WAIT_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _put(self, output, item):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped
+            try:
+                output.put(item, timeout=WAIT_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _check_chunks(self):
+        reader = self.reader
+        batch = []
+        batch_size = 0
+        for number, chunk, check in self.idat_chunks:
+            data = reader.get_chunk_data(chunk)
+            if check:
+                reader._check_crc(chunk.type, data, chunk.crc, number)
+            # IDAT chunks are often small, so they are passed on in
+            # batches to keep the queue traffic low
+            batch.append(data)
+            batch_size += len(data)
+            if batch_size >= PIECE_SIZE:
+                self._put(self._checked, batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            self._put(self._checked, batch)
+
+    def _inflate(self):
+        stats = self.reader.stats
+        decompressor = zlib.decompressobj()
+        # inflated pieces are passed on as they are and joined only once
+        # by the next stage
+        output = []
+        output_size = 0
+        while True:
+            batch = self._get(self._checked)
+            if batch is _END:
+                break
+            for piece in batch:
+                while piece:
+                    start_time = time.perf_counter()
+                    with zlib_errors():
+                        inflated = decompressor.decompress(piece, PIECE_SIZE)
+                    if stats is not None:
+                        stats.add('inflate', time.perf_counter() - start_time,
+                                  len(inflated))
+                    output.append(inflated)
+                    output_size += len(inflated)
+                    if output_size >= BATCH_SIZE:
+                        self._put(self._inflated, output)
+                        output = []
+                        output_size = 0
+                    piece = decompressor.unconsumed_tail
+        with zlib_errors():
+            output.append(decompressor.flush())
+        self.reader._check_stream_end(decompressor)
+        self._put(self._inflated, output)
+
+    def _undo_filter(self):
+        reader = self.reader
+        stats = reader.stats
+        row_bytes = reader.row_bytes
+        line_bytes = row_bytes + 1
+        height = reader.header.height
+        engine = reader._get_filter_engine()
+        image_bytes = bytearray(row_bytes * height)
+        # the start of a scanline left over from the last batch
+        pending = b''
+        previous = None
+        y = 0
+        while True:
+            batch = self._get(self._inflated)
+            if batch is _END:
+                break
+            if y == height:
+                # data past the last row is ignored, but the CRCs of all
+                # chunks are still checked
+                continue
+            data = b''.join([pending] + batch)
+            count = min(len(data) // line_bytes, height - y)
+            if not count:
+                pending = data
+                continue
+            start_time = time.perf_counter()
+            with memoryview(data) as view:
+                if stats is not None:
+                    stats.count_filters(view[:count * line_bytes:line_bytes])
+                rows = engine.undo_filter(view[:count * line_bytes], previous)
+                pending = bytes(view[count * line_bytes:])
+            image_bytes[y * row_bytes:(y + count) * row_bytes] = rows
+            y += count
+            # the last row of the batch, without copying it
+            previous = memoryview(rows)[-row_bytes:]
+            if stats is not None:
+                stats.add('unfilter', time.perf_counter() - start_time,
+                          count * line_bytes)
+        del image_bytes[y * row_bytes:]
+        return image_bytes
@@ -1,11 +1,18 @@
 import struct
 import os
+import io
 import re
 import zlib
 import math
-import sys
-from array import array
-from . import image
+import copy
+import mmap
+import time
+import itertools
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from . import image, filters, pipeline, apng
+from .errors import PNGError, zlib_errors
 
 COLOUR_TYPES = {
     0: ('Grayscale', (1, 2, 4, 8, 16)),
@@ -17,6 +24,19 @@ COLOUR_TYPES = {
 
 PNG_SIGNATURE = [137, 80, 78, 71, 13, 10, 26, 10]
 
+# upper bound for one piece of inflated data in streaming mode
+INFLATE_CHUNK_SIZE = 2 ** 16
+
+# bytes asked for in one read from a stream
+READ_SIZE = 2 ** 16
+
+# CRCs checked: of every chunk, of critical chunks only, of every chunk on
+# a background thread while decoding, or of none
+INTEGRITY_LEVELS = ('full', 'critical', 'deferred', 'off')
+
+ChunkInfo = collections.namedtuple(
+    'ChunkInfo', ['type', 'offset', 'length', 'crc'])
+
 ADAM7 = ((0, 0, 8, 8),
          (4, 0, 8, 8),
          (0, 4, 4, 8),
@@ -63,224 +83,747 @@ class Header:
         return info
 
     def _check_info(self):
-        if self.width == 0 or self.height == 0:
-            sys.exit('Incorrect dimensions')
+        check_header_info(vars(self))
+
+
+def check_header_info(info):
+    """Checks the IHDR fields given as a dict keyed by Header attributes"""
+    if info['width'] == 0 or info['height'] == 0:
+        raise PNGError('Incorrect dimensions')
+
+    color_type = info['color_type']
+    if color_type not in COLOUR_TYPES:
+        raise PNGError('Incorrect colour type: {}'.format(color_type))
+
+    if info['bit_depth'] not in COLOUR_TYPES[color_type][1]:
+        raise PNGError('Incorrect bit depth or bit depth not matching '
+                       'the color type: {}'.format(info['bit_depth']))
 
-        if self.color_type not in COLOUR_TYPES:
-            sys.exit('Incorrect colour type: {}'.format(self.color_type))
+    if info['compression_method'] != 0:
+        raise PNGError('Incorrect compression method: {}'.format(
+            info['compression_method']))
 
-        if self.bit_depth not in COLOUR_TYPES[self.color_type][1]:
-            sys.exit('Incorrect bit depth or bit depth not matching '
-                     'the color type: {}'.format(self.bit_depth))
+    if info['filter_method'] != 0:
+        raise PNGError('Incorrect filter method: {}'.format(
+            info['filter_method']))
 
-        if self.compression_method != 0:
-            sys.exit('Incorrect compression method: {}'.format(
-                self.compression_method))
+    if info['interlace_method'] not in (0, 1):
+        raise PNGError('Incorrect interlace method: {}'.format(
+            info['interlace_method']))
 
-        if self.filter_method != 0:
-            sys.exit('Incorrect filter method: {}'.format(
-                self.filter_method))
 
-        if self.interlace_method not in (0, 1):
-            sys.exit('Incorrect interlace method: {}'.format(
-                self.interlace_method))
+def is_file_name(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+def is_buffer(source):
+    return isinstance(source, (bytes, bytearray, memoryview))
 
 
 def check_png_signature(signature):
     for (i, byte) in enumerate(signature):
         if byte != PNG_SIGNATURE[i]:
-            sys.exit(
+            raise PNGError(
                 'Incorrect PNG signature: {} byte should be {} '
                 'but was {}'.format(i, PNG_SIGNATURE[i], byte))
 
 
+class Probe:
+    """Reads only the signature and IHDR chunk of a PNG file.
+
+    Source is a file name, bytes-like data or a readable binary file
+    object, as for Reader. With walk_chunks the headers of the remaining
+    chunks are indexed too, skipping their payloads, which are neither
+    checked nor, in seekable files, read.
+    """
+
+    def __init__(self, source, walk_chunks=False):
+        self.file_name = source if is_file_name(source) else None
+        self.chunk_index = []
+        if is_file_name(source):
+            f = open(source, 'rb')
+        elif is_buffer(source):
+            f = io.BytesIO(source)
+        else:
+            # the stream belongs to the caller
+            f = contextlib.nullcontext(source)
+        with f as f:
+            self._read_header(f)
+            if walk_chunks:
+                self._walk_chunks(f)
+
+    def _read_header(self, f):
+        start = self._read(f, len(PNG_SIGNATURE) + 25)
+        check_png_signature(start[:len(PNG_SIGNATURE)])
+        if len(start) < len(PNG_SIGNATURE) + 8:
+            raise PNGError('No IHDR chunk')
+        length, chunk_type = struct.unpack_from(
+            '!L4s', start, len(PNG_SIGNATURE))
+        if chunk_type != b'IHDR':
+            raise PNGError('No IHDR chunk')
+        if length != 13 or len(start) < len(PNG_SIGNATURE) + 25:
+            raise PNGError('Incorrect IHDR chunk length')
+
+        data = start[len(PNG_SIGNATURE) + 8:len(PNG_SIGNATURE) + 21]
+        self.header = Header(*struct.unpack('!LLBBBBB', data))
+        crc = struct.unpack_from('!L', start, len(PNG_SIGNATURE) + 21)[0]
+        if zlib.crc32(chunk_type + data) != crc:
+            raise PNGError('Control sum doesnt match at 1 chunk, '
+                           'chunk type: {}'.format(chunk_type))
+        self.chunk_index.append(
+            ChunkInfo(chunk_type, len(PNG_SIGNATURE) + 8, length, crc))
+
+    def _walk_chunks(self, f):
+        offset = len(PNG_SIGNATURE) + 25
+        chunk_start = self._read(f, 8)
+        while len(chunk_start) == 8:
+            length, chunk_type = struct.unpack('!L4s', chunk_start)
+            data_offset = offset + 8
+            self._skip(f, length)
+            # the CRC and the header of the next chunk in one read
+            chunk_end = self._read(f, 12)
+            if len(chunk_end) < 4:
+                break
+            crc = struct.unpack_from('!L', chunk_end)[0]
+            self.chunk_index.append(
+                ChunkInfo(chunk_type, data_offset, length, crc))
+            if chunk_type == b'IEND':
+                break
+            offset = data_offset + length + 4
+            chunk_start = chunk_end[4:]
+
+    def _read(self, f, size):
+        """Reads size bytes unless the file ends, as streams may return
+        less at a time"""
+        data = f.read(size)
+        while data and len(data) < size:
+            piece = f.read(size - len(data))
+            if not piece:
+                break
+            data += piece
+        return data
+
+    def _skip(self, f, length):
+        if getattr(f, 'seekable', lambda: False)():
+            f.seek(length, os.SEEK_CUR)
+            return
+        # pipes can only be read through
+        while length:
+            skipped = len(f.read(min(length, READ_SIZE)))
+            if not skipped:
+                break
+            length -= skipped
+
+
 class Reader:
-    def __init__(self, file_name, without_decoding=False):
-        self.file_name = file_name
+    """Reads and decodes a PNG file.
+
+    Given a stats.DecodeStats object, the reader adds the time, bytes and
+    allocations of its stages to it. Given a disk_cache.DiskCache, decoded
+    pixels are loaded from it when the file has not changed and are
+    stored to it after decoding otherwise. A pipelined reader checks IDAT
+    CRCs, inflates and unfilters on separate threads at the same time.
+
+    Source is a file name, bytes-like data or a readable binary file
+    object. File objects are read chunk by chunk as the data arrives and
+    are never seeked, so pipes, sockets and sys.stdin.buffer work too.
+    CRCs are checked and, if the reader decodes, IDAT data is inflated
+    while reading, before the rest of the stream has arrived. A lazy
+    reader created without decoding reads a stream only up to its first
+    IDAT chunk, unless it is animated, and reads the rest while the rows
+    are decoded for the first time, so the first rows are known before
+    the stream ends. Its CRCs are always checked while reading.
+
+    Integrity is one of INTEGRITY_LEVELS. Deferred CRC errors are raised
+    when the reader has finished decoding. A reader created without
+    decoding keeps checking CRCs in the background and raises their
+    error when iter_rows(), iter_passes() or a decode_*() method ends, or
+    from finish_crc_check(). Unless integrity is 'off', a
+    zlib stream inflated to its end must end with its Adler-32 checksum,
+    which zlib verifies anyway.
+    """
+
+    def __init__(self, source, without_decoding=False, to_8bit=False,
+                 stats=None, cache=None, pipelined=False, integrity='full',
+                 lazy=False):
+        if integrity not in INTEGRITY_LEVELS:
+            raise ValueError('Unknown integrity level: {}'.format(integrity))
+        if cache is not None and not is_file_name(source):
+            raise ValueError('The disk cache needs a file name')
+        self.source = source
+        self.file_name = source if is_file_name(source) else None
+        self._stream = None
+        if not is_file_name(source) and not is_buffer(source):
+            self._stream = source
+            # the stream is inflated while it is read instead
+            pipelined = False
+        # decompressor and inflated pieces of IDAT data read from a stream
+        self._stream_inflate = None
+        if self._stream is not None and not without_decoding:
+            self._stream_inflate = (zlib.decompressobj(),
+                                   collections.deque())
+        self.stats = stats
+        self.cache = cache
+        self.integrity = integrity
+        # (chunk number, ChunkInfo) of chunks checked on a background thread
+        self.deferred_chunks = []
+        self._crc_check = None
+        # (chunk number, ChunkInfo, whether to check the CRC) of IDAT
+        # chunks read by the pipeline, which also checks their CRCs; the
+        # CRCs of chunks read for other uses are checked here
+        self.pipelined_idat = []
+        self.pipelined = pipelined and not without_decoding and \
+            cache is None and pipeline.is_available()
+        self.lazy = lazy and without_decoding and self._stream is not None
+        # chunks of a lazy reader, read from the first IDAT chunk on when
+        # rows are decoded
+        self._rest = None
+        self._reading_lazily = False
 
         self.chunk_count = 0
         self.idat_count = 0
+        self.chunk_index = []
         self.chunks_list = []
         self.chunk_types = []
         self.idat_list = []
         self.PLTE = None
-        self._read_file()
-        self._process_chunks()
-        self.image = image.Image(self)
-        if not without_decoding:
-            self._decode_IDAT()
+        self.tRNS = None
+        self.palette = None
+        self.palette_channels = 3
+        self.acTL = None
+        # apng.Animation indexed at open time if the file is animated
+        self.animation = None
+        if self.file_name is not None:
+            size = os.path.getsize(self.file_name)
+        elif self._stream is None:
+            size = memoryview(source).nbytes
+        else:
+            # the length of a stream is not known in advance
+            size = 0
+        with self._measure('read', size):
+            try:
+                self._read_file()
+                self._start_crc_check()
+                self._process_chunks()
+            except PNGError:
+                # a corrupted chunk is the cause of the error, if any
+                self._start_crc_check()
+                self.finish_crc_check()
+                raise
+        self.image = image.Image(self, to_8bit)
+        if without_decoding:
+            # deferred CRCs are checked while rows are decoded later
+            return
+        loaded = False
+        with self._checked_decoding():
+            if cache is not None:
+                with self._measure('cache'):
+                    loaded = cache.load(self)
+            if not loaded:
+                self._decode_IDAT()
+        # only checked pixels are stored
+        if cache is not None and not loaded:
+            cache.store(self)
 
     def _read_file(self):
-        with open(self.file_name, 'rb') as f:
-            png_signature = f.read(8)
-            check_png_signature(png_signature)
-            self._read_header(f)
-
-            if self.header.interlace_method == 1:
-                # TODO
-                sys.exit(
-                    'Sorry, this program does not work with interlaced images')
-
-            while True:
-                len_b = f.read(4)
-                if len_b == '':
-                    sys.exit('No IEND chunk')
-                length = struct.unpack('!L', len_b)[0]
-                chunk_type = f.read(4)
-                data = f.read(length)
-                crc = f.read(4)
-                self._check_crc(chunk_type, data, crc)
-                self.chunk_count += 1
-                if chunk_type == b'IDAT':
-                    self.idat_count += 1
-                if chunk_type == b'IEND':
-                    break
-                else:
-                    self.chunks_list.append((chunk_type, data))
-                    self.chunk_types.append(chunk_type)
-            self.chunks_set = set(self.chunk_types)
+        if self.file_name is not None:
+            self.file_data = self._map_file()
+        elif self._stream is None:
+            self.file_data = memoryview(self.source).cast('B')
+        else:
+            # a growing buffer until the whole stream is read
+            self.file_data = bytearray()
+        self._fill(len(PNG_SIGNATURE))
+        check_png_signature(self.file_data[:len(PNG_SIGNATURE)])
+        header_chunk = self._index_chunk(len(PNG_SIGNATURE))
+        if header_chunk is None or header_chunk.type != b'IHDR':
+            raise PNGError('No IHDR chunk')
+        self._read_header(header_chunk)
+
+        self._rest = self._read_chunks(
+            header_chunk.offset + header_chunk.length + 4)
+        # only a lazy reader stops, before the first IDAT chunk
+        for _ in self._rest:
+            break
+        if not self._reading_lazily:
+            self._rest = None
+            return
+        # copies, since the buffer of the stream keeps growing
+        self.chunks_list = [(chunk.type, bytes(self.get_chunk_data(chunk)))
+                            for chunk in self.chunk_index[1:]]
+
+    def _read_chunks(self, offset):
+        """Reads the chunks from offset up to IEND.
+
+        A lazy reader yields None before the first IDAT chunk and then the
+        data of every IDAT chunk as it is read.
+        """
+        while True:
+            if self.lazy and not self.idat_count and \
+                    b'acTL' not in self.chunk_types and \
+                    self._peek_chunk_type(offset) == b'IDAT':
+                self._reading_lazily = True
+                yield None
+            chunk = self._index_chunk(offset)
+            if chunk is None:
+                raise PNGError('No IEND chunk')
+            offset = chunk.offset + chunk.length + 4
+            # views of a growing buffer are released before it grows
+            with memoryview(self.file_data) as view, \
+                    view[chunk.offset:chunk.offset + chunk.length] as data:
+                self._verify_chunk(chunk, data)
+                if chunk.type == b'IDAT' and \
+                        self._stream_inflate is not None:
+                    self._inflate_stream(data)
+                if chunk.type == b'IDAT' and self._reading_lazily:
+                    data = bytes(data)
+            self.chunk_count += 1
+            if chunk.type == b'IDAT':
+                self.idat_count += 1
+                if self._reading_lazily:
+                    yield data
+            if chunk.type == b'IEND':
+                break
+            else:
+                self.chunk_types.append(chunk.type)
+        self.chunks_set = set(self.chunk_types)
+        if self._stream is not None:
+            self.file_data = memoryview(self.file_data)
+        processed = len(self.chunks_list)
+        # every chunk between IHDR and IEND
+        self.chunks_list = [(chunk.type, self.get_chunk_data(chunk))
+                            for chunk in self.chunk_index[1:-1]]
 
         if self.idat_count == 0:
-            sys.exit('No IDAT chunks')
+            raise PNGError('No IDAT chunks')
+        if self._reading_lazily:
+            # the chunks before the first IDAT chunk are processed already
+            self._process_chunk_list(self.chunks_list[processed:])
+
+    def _peek_chunk_type(self, offset):
+        self._fill(offset + 8)
+        if offset + 8 > len(self.file_data):
+            return None
+        return bytes(self.file_data[offset + 4:offset + 8])
+
+    def _fill(self, size):
+        """Reads a stream until at least size bytes are buffered or it
+        ends"""
+        if self._stream is None:
+            return
+        # read1 returns the data that has arrived instead of waiting
+        read = getattr(self._stream, 'read1', self._stream.read)
+        while len(self.file_data) < size:
+            data = read(max(size - len(self.file_data), READ_SIZE))
+            if not data:
+                break
+            self.file_data += data
+
+    def _inflate_stream(self, data):
+        decompressor, pieces = self._stream_inflate
+        start = time.perf_counter()
+        with zlib_errors():
+            inflated = decompressor.decompress(data)
+        self._add_inflate_stats(start, inflated)
+        pieces.append(inflated)
+
+    def _map_file(self):
+        with open(self.file_name, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return memoryview(b'')
+            return memoryview(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _index_chunk(self, offset):
+        """Adds the chunk starting at offset to the chunk index.
+
+        Returns None if the file ends before the chunk does.
+        """
+        self._fill(offset + 8)
+        if offset + 8 > len(self.file_data):
+            return None
+        length, chunk_type = struct.unpack_from(
+            '!L4s', self.file_data, offset)
+        data_offset = offset + 8
+        self._fill(data_offset + length + 4)
+        if data_offset + length + 4 > len(self.file_data):
+            return None
+        crc = struct.unpack_from(
+            '!L', self.file_data, data_offset + length)[0]
+        chunk = ChunkInfo(chunk_type, data_offset, length, crc)
+        self.chunk_index.append(chunk)
+        return chunk
+
+    def get_chunk_data(self, chunk):
+        """Returns the chunk payload as a view of the mapped file"""
+        return self.file_data[chunk.offset:chunk.offset + chunk.length]
 
     def _process_chunks(self):
-        for (chunk_type, data) in self.chunks_list:
+        self._process_chunk_list(self.chunks_list)
+        if self.header.color_type == 3 and not self.PLTE:
+            raise PNGError(
+                'There should be a palette chunk for indexed image')
+        if self.header.color_type == 3:
+            self._build_palette()
+        if self.acTL is not None:
+            self.animation = apng.Animation(self, *self.acTL)
+        # TODO: process other chunks
+
+    def _process_chunk_list(self, chunks):
+        for (chunk_type, data) in chunks:
             if chunk_type == b'PLTE':
                 if self.PLTE:
-                    sys.exit('There should be only one palette chunk')
+                    raise PNGError(
+                        'There should be only one palette chunk')
                 self._process_PLTE(data)
+            if chunk_type == b'tRNS' and self.header.color_type == 3:
+                self._process_tRNS(data)
             if chunk_type == b'IDAT':
                 self.idat_list.append(data)
-        if self.header.color_type == 3 and not self.PLTE:
-            sys.exit('There should be a palette chunk for indexed image')
-        # TODO: process other chunks
+            # an acTL chunk after image data does not make an animation
+            if chunk_type == b'acTL' and not self.idat_list:
+                if len(data) != 8 or self.acTL is not None:
+                    raise PNGError('Incorrect acTL chunk')
+                self.acTL = struct.unpack('!LL', data)
 
     def _process_PLTE(self, data):
         if len(data) % 3 != 0:
-            sys.exit('Incorrect palette chunk length')
+            raise PNGError('Incorrect palette chunk length')
         plte_count = len(data) // 3
         if plte_count > 2 ** self.header.bit_depth:
-            sys.exit('To many palette colors: {}'.format(plte_count - 1))
-        self.PLTE = {i: data[i * 3: i * 3 + 3] for i in range(plte_count)}
+            raise PNGError(
+                'To many palette colors: {}'.format(plte_count - 1))
+        self.PLTE = bytes(data)
+
+    def _process_tRNS(self, data):
+        if not self.PLTE or self.idat_list:
+            raise PNGError('Incorrect tRNS chunk position')
+        if len(data) > len(self.PLTE) // 3:
+            raise PNGError('Incorrect tRNS chunk length')
+        self.tRNS = bytes(data)
+
+    def _build_palette(self):
+        """Builds a flat table of 256 RGB or RGBA entries.
+
+        Every channel slice palette[i::palette_channels] can be used as a
+        bytes.translate() table from colour indices to that channel.
+        Alpha comes from the tRNS chunk, indices without a colour are black.
+        """
+        channels = 3 if self.tRNS is None else 4
+        plte_count = len(self.PLTE) // 3
+        palette = bytearray(256 * channels)
+        for i in range(3):
+            palette[i:plte_count * channels:channels] = self.PLTE[i::3]
+        if channels == 4:
+            palette[3::4] = b'\xff' * 256
+            palette[3:len(self.tRNS) * 4:4] = self.tRNS
+        self.palette = bytes(palette)
+        self.palette_channels = channels
 
     def _decode_IDAT(self):
-        idat_data = b''.join(self.idat_list)
-        decompressed_data = zlib.decompress(idat_data)
-        image_rows_list = self._undo_filter(decompressed_data)
-        self.image.get_image(image_rows_list)
+        if self.pipelined and not self.header.interlace_method:
+            image_bytes = pipeline.Pipeline(self, self.pipelined_idat).run()
+        elif self.header.interlace_method:
+            for number, chunk, check in self.pipelined_idat:
+                if check:
+                    self._check_crc(chunk.type, self.get_chunk_data(chunk),
+                                    chunk.crc, number)
+            for _, image_bytes in self.iter_passes():
+                pass
+        else:
+            decompressed_data = bytearray()
+            for piece in self._inflate():
+                decompressed_data += piece
+            if self.stats is not None:
+                self.stats.count_filters(
+                    decompressed_data[::self.row_bytes + 1])
+            with self._measure('unfilter', len(decompressed_data)):
+                image_bytes = self._undo_filter(decompressed_data)
+        image_bytes = memoryview(image_bytes)
+        with self._measure('unpack', len(image_bytes)):
+            self.image.get_image(
+                image_bytes[i:i + self.row_bytes]
+                for i in range(0, len(image_bytes), self.row_bytes))
+
+    def _measure(self, stage, size=0):
+        if self.stats is None:
+            return contextlib.nullcontext()
+        return self.stats.measure(stage, size)
+
+    def close(self):
+        """Releases the file data, such as the memory map of a file.
+
+        The decoded image stays usable, nothing else can be decoded.
+        """
+        self.finish_crc_check()
+        self.file_data = None
+        self.chunks_list = []
+        self.idat_list = []
+        self.deferred_chunks = []
+        self.pipelined_idat = []
+        self._stream_inflate = None
+        # frames hold chunk data
+        self.animation = None
+
+    def decode_frame(self, width, height, idat_list):
+        """Decodes zlib data of an APNG frame of the given size into an
+        image.Image with 8-bit samples"""
+        frame = copy.copy(self)
+        frame.header = copy.copy(self.header)
+        frame.header.width = width
+        frame.header.height = height
+        frame.row_bytes = int(math.ceil(width * self.bytes_per_pixel))
+        frame.idat_list = idat_list
+        frame.pipelined = False
+        # the chunks of the default image are not read again
+        frame.pipelined_idat = []
+        frame._stream_inflate = None
+        frame.image = image.Image(frame, to_8bit=True)
+        with self._checked_decoding():
+            frame._decode_IDAT()
+        return frame.image
+
+    def decode_region(self, x0, y0, x1, y1, to_8bit=False):
+        """Decodes columns x0..x1 of rows y0..y1, ends excluded, into a new
+        image.Image.
+
+        Rows are reconstructed one at a time and no IDAT data is inflated
+        past row y1. Every Adam7 pass spans the whole image, so interlaced
+        images are decoded completely and then cropped.
+        """
+        if not (0 <= x0 < x1 <= self.header.width and
+                0 <= y0 < y1 <= self.header.height):
+            raise PNGError('Incorrect region: ({}, {}) - ({}, {})'.format(
+                x0, y0, x1, y1))
+        region_image = image.Image(self, to_8bit, (x0, y0, x1, y1))
+        with self._checked_decoding():
+            region_image.get_image(
+                itertools.islice(self.iter_rows(), y0, y1))
+        return region_image
+
+    def decode_thumbnail(self, max_size):
+        """Decodes the image scaled down to at most max_size pixels on its
+        longer side into an image.Thumbnail with 8-bit grey, RGB or RGBA
+        pixels.
+
+        Every output pixel is the average of a box of source pixels, added
+        up while rows are reconstructed, so full-resolution pixels are
+        never held. Interlaced images are decoded completely first.
+        """
+        factor = max(1, -(-max(self.header.width, self.header.height) //
+                          max_size))
+        row_image = image.Image(self, to_8bit=True)
+        scaler = None
+        with self._checked_decoding():
+            for row in self.iter_rows():
+                pixels, channels = row_image.get_display_pixels(
+                    row_image.get_row_samples(row))
+                if scaler is None:
+                    scaler = image.BoxScaler(
+                        self.header.width, self.header.height, channels,
+                        factor)
+                scaler.add_row(pixels)
+            if scaler is None:
+                raise PNGError('No image data')
+        pixels = scaler.finish()
+        return image.Thumbnail(scaler.out_width, len(pixels) //
+                               (scaler.out_width * scaler.channels),
+                               scaler.channels, pixels)
+
+    def iter_rows(self):
+        """Yields reconstructed scanlines one at a time.
+
+        IDAT chunks are inflated incrementally, so only the current piece
+        of inflated data and the previous row are kept in memory.
+        Interlaced images are deinterlaced completely before the first row.
+        """
+        with self._checked_decoding():
+            yield from self._iter_rows()
+
+    def _iter_rows(self):
+        if self.header.interlace_method:
+            for _, image_bytes in self.iter_passes():
+                pass
+            for i in range(0, len(image_bytes), self.row_bytes):
+                yield image_bytes[i:i + self.row_bytes]
+            return
+
+        engine = self._get_filter_engine()
+        line_bytes = self.row_bytes + 1
+        rows_left = self.header.height
+        previous = None
+        pending = bytearray()
+        inflated = self._inflate()
+        for piece in inflated:
+            pending += piece
+            offset = 0
+            with memoryview(pending) as view:
+                while rows_left and len(pending) - offset >= line_bytes:
+                    previous = engine.unfilter_row(
+                        view[offset], view[offset + 1:offset + line_bytes],
+                        previous)
+                    offset += line_bytes
+                    rows_left -= 1
+                    yield previous
+            del pending[:offset]
+            if not rows_left:
+                break
+        if self._reading_lazily:
+            # the rest of the stream is still read and checked
+            for _ in inflated:
+                pass
+
+    def iter_passes(self):
+        """Yields (pass index, image bytes) after every decoded Adam7 pass.
+
+        Image bytes is the buffer of reconstructed scanlines shared by all
+        passes, so after the first pass it already holds every 8th pixel
+        of every 8th row and can be shown as a coarse preview. Images
+        without interlacing are decoded as a single pass.
+        """
+        with self._checked_decoding():
+            yield from self._iter_passes()
+
+    def _iter_passes(self):
+        image_bytes = bytearray(self.row_bytes * self.header.height)
+        if not self.header.interlace_method:
+            for y, row in enumerate(self.iter_rows()):
+                image_bytes[y * self.row_bytes:(y + 1) * self.row_bytes] = row
+            yield 0, image_bytes
+            return
+
+        passes = self._get_passes()
+        pending = bytearray()
+        inflated = self._inflate()
+        for pass_index, (x0, y0, dx, dy) in enumerate(ADAM7):
+            width, height, row_bytes = passes[pass_index]
+            if not width or not height:
+                continue
+            pass_size = height * (row_bytes + 1)
+            while len(pending) < pass_size:
+                piece = next(inflated, None)
+                if piece is None:
+                    return
+                pending += piece
+            if self.stats is not None:
+                self.stats.count_filters(pending[:pass_size:row_bytes + 1])
+            with memoryview(pending) as view, \
+                    self._measure('unfilter', pass_size):
+                pass_bytes = self._get_filter_engine(row_bytes).undo_filter(
+                    view[:pass_size])
+            del pending[:pass_size]
+            with self._measure('deinterlace', len(pass_bytes)):
+                self._scatter_pass(image_bytes, pass_bytes, row_bytes,
+                                   width, height, x0, y0, dx, dy)
+            yield pass_index, image_bytes
+        # data past the last pass still has to reach the end of the stream
+        for _ in inflated:
+            pass
+
+    def _get_passes(self):
+        """Returns (width, height, row bytes) of every Adam7 pass"""
+        bits_per_pixel = self.header.bit_depth * self.total_samples_count
+        passes = []
+        for x0, y0, dx, dy in ADAM7:
+            width = max(0, (self.header.width - x0 + dx - 1) // dx)
+            height = max(0, (self.header.height - y0 + dy - 1) // dy)
+            passes.append(
+                (width, height, (width * bits_per_pixel + 7) // 8))
+        return passes
+
+    def _scatter_pass(self, image_bytes, pass_bytes, pass_row_bytes,
+                      width, height, x0, y0, dx, dy):
+        bit_depth = self.header.bit_depth
+        pixel_bytes = int(self.bytes_per_pixel)
+        for pass_y in range(height):
+            row_start = (y0 + pass_y * dy) * self.row_bytes
+            pass_row = pass_bytes[pass_y * pass_row_bytes:
+                                  (pass_y + 1) * pass_row_bytes]
+            if bit_depth >= 8:
+                step = dx * pixel_bytes
+                for k in range(pixel_bytes):
+                    start = row_start + x0 * pixel_bytes + k
+                    image_bytes[start:start + (width - 1) * step + 1:step] = \
+                        pass_row[k::pixel_bytes]
+                continue
+
+            # sub-byte depths have a single sample per pixel
+            mask = (1 << bit_depth) - 1
+            for i in range(width):
+                bit = i * bit_depth
+                sample = (pass_row[bit >> 3] >>
+                          (8 - bit_depth - (bit & 7))) & mask
+                bit = (x0 + i * dx) * bit_depth
+                image_bytes[row_start + (bit >> 3)] |= \
+                    sample << (8 - bit_depth - (bit & 7))
+
+    def _inflate(self):
+        decompressor = zlib.decompressobj()
+        idat_list = self.idat_list
+        if self._stream_inflate is not None:
+            # IDAT data read from a stream was inflated while reading
+            (decompressor, pieces), self._stream_inflate = \
+                self._stream_inflate, None
+            while pieces:
+                yield pieces.popleft()
+            idat_list = []
+        elif self._rest is not None:
+            # the rest of a lazily read stream, which is read only once
+            idat_list, self._rest = self._rest, None
+        for data in idat_list:
+            data = memoryview(data)
+            # bounded input keeps the unconsumed tail copies small
+            for start in range(0, len(data), INFLATE_CHUNK_SIZE):
+                piece = data[start:start + INFLATE_CHUNK_SIZE]
+                while piece:
+                    start = time.perf_counter()
+                    with zlib_errors():
+                        inflated = decompressor.decompress(
+                            piece, INFLATE_CHUNK_SIZE)
+                    self._add_inflate_stats(start, inflated)
+                    yield inflated
+                    piece = decompressor.unconsumed_tail
+        start = time.perf_counter()
+        with zlib_errors():
+            inflated = decompressor.flush()
+        self._add_inflate_stats(start, inflated)
+        self._check_stream_end(decompressor)
+        yield inflated
+
+    def _check_stream_end(self, decompressor):
+        """Checks that all IDAT data ends with a complete zlib stream.
+
+        Zlib compares the Adler-32 checksum at the end of the stream with
+        the inflated data itself, so only a missing end is checked here.
+        """
+        if self.integrity != 'off' and not decompressor.eof:
+            raise PNGError('Incorrect zlib stream: no Adler-32 checksum '
+                           'at the end of IDAT data')
+
+    def _add_inflate_stats(self, start, inflated):
+        if self.stats is not None:
+            self.stats.add('inflate', time.perf_counter() - start,
+                           len(inflated))
 
     def _undo_filter(self, data):
-        bytes_array = array('B', data)
-        image_bytes = []
-        recon = None
-        while len(bytes_array) >= self.row_bytes + 1:
-            filter_type = bytes_array[0]
-            scanline = bytes_array[1:self.row_bytes + 1]
-            del bytes_array[:self.row_bytes + 1]
-            recon = self._process_filter(filter_type, scanline, recon)
-            image_bytes.append(recon)
-        return image_bytes
-
-    def _process_filter(self, filter_type, scanline, previous):
-        if filter_type not in (0, 1, 2, 3, 4):
-            sys.exit('Unknown filter: {}'.format(filter_type))
-
-        if filter_type == 0:
-            return scanline
-
-        if not previous:
-            previous = array('B', [0] * len(scanline))
-
-        filter_unit = int(max(1, self.bytes_per_pixel))
-        result_line = scanline
-
-        def sub():
-            prev_i = 0  # pixel before
-            for i in range(filter_unit, len(result_line)):
-                current_byte = scanline[i]
-                previous_byte = result_line[prev_i]
-                result_line[i] = (current_byte + previous_byte) % 256
-                prev_i += 1
-
-        def up():
-            for i in range(len(result_line)):
-                current_byte = scanline[i]
-                above_byte = previous[i]
-                result_line[i] = (current_byte + above_byte) % 256
-
-        def average():
-            prev_i = -filter_unit
-            for i in range(len(result_line)):
-                current_byte = scanline[i]
-                if prev_i < 0:
-                    previous_byte = 0
-                else:
-                    previous_byte = result_line[prev_i]
-                above_byte = previous[i]
-                result_line[i] = (current_byte +
-                                  ((previous_byte + above_byte) >> 1)) % 256
-                prev_i += 1
-
-        def paeth():
-            prev_i = -filter_unit
-            for i in range(len(result_line)):
-                current_byte = scanline[i]
-                if prev_i < 0:
-                    previous_byte = previous_above_byte = 0
-                else:
-                    previous_byte = result_line[prev_i]
-                    previous_above_byte = previous[prev_i]
-                above_byte = previous[i]
-                p = previous_byte + above_byte - previous_above_byte
-                pa = abs(p - previous_byte)
-                pb = abs(p - above_byte)
-                pc = abs(p - previous_above_byte)
-                if pa <= pb and pa <= pc:
-                    pr = previous_byte
-                elif pb <= pc:
-                    pr = above_byte
-                else:
-                    pr = previous_above_byte
-                result_line[i] = (current_byte + pr) % 256
-                prev_i += 1
-
-        if filter_type == 1:
-            sub()
-        if filter_type == 2:
-            up()
-        if filter_type == 3:
-            average()
-        if filter_type == 4:
-            paeth()
-
-        return result_line
+        return self._get_filter_engine().undo_filter(data)
 
-    def _read_header(self, f):
-        header_len_b = f.read(4)
-        if header_len_b == '':
-            sys.exit('No IHDR chunk')
-        header_len = struct.unpack('!L', header_len_b)[0]
-        chunk_type = f.read(4)
-        if chunk_type != b'IHDR':
-            sys.exit('No IHDR chunk')
-        if header_len != 13:
-            sys.exit('Incorrect IHDR chunk length')
+    def _get_filter_engine(self, row_bytes=None):
+        if row_bytes is None:
+            row_bytes = self.row_bytes
+        return filters.get_engine(
+            row_bytes, int(max(1, self.bytes_per_pixel)))
+
+    def _read_header(self, chunk):
+        if chunk.length != 13:
+            raise PNGError('Incorrect IHDR chunk length')
 
         self.chunk_count += 1
-        data = f.read(13)
+        data = self.get_chunk_data(chunk)
 
-        self.header = Header(
-            struct.unpack('!L', data[0:4])[0],
-            struct.unpack('!L', data[4:8])[0],
-            struct.unpack('B', data[8:9])[0],
-            struct.unpack('B', data[9:10])[0],
-            struct.unpack('B', data[10:11])[0],
-            struct.unpack('B', data[11:12])[0],
-            struct.unpack('B', data[12:])[0]
-        )
+        self.header = Header(*struct.unpack('!LLBBBBB', data))
 
-        header_crc = f.read(4)
-        self._check_crc(chunk_type, data, header_crc)
+        self._verify_chunk(chunk, data)
 
         color_channels = (3 if self.header.color_type in (2, 6) else 1)
         alpha = (1 if self.header.color_type in (4, 6) else 0)
@@ -290,10 +833,59 @@ class Reader:
         self.row_bytes = int(
             math.ceil(self.header.width * self.bytes_per_pixel))
 
-    def _check_crc(self, chunk_type, data, crc):
-        counted_crc = zlib.crc32(chunk_type + data)
-        actual_crc = struct.unpack('!L', crc)[0]
-        if counted_crc != actual_crc:
-            sys.exit(
+    def _verify_chunk(self, chunk, data):
+        """Checks the CRC of a chunk now, later or never by integrity"""
+        # bit 5 of the first type byte is set in ancillary chunks
+        check = self.integrity != 'off' and not (
+            self.integrity == 'critical' and chunk.type[0] & 0x20)
+        if self.pipelined and chunk.type == b'IDAT':
+            # the pipeline reads IDAT chunks at every level
+            self.pipelined_idat.append((self.chunk_count, chunk, check))
+        elif not check:
+            return
+        elif self.integrity == 'deferred' and not self.lazy:
+            self.deferred_chunks.append((self.chunk_count, chunk))
+        else:
+            self._check_crc(chunk.type, data, chunk.crc)
+
+    def _start_crc_check(self):
+        if not self.deferred_chunks or self._crc_check is not None:
+            return
+        pool = ThreadPoolExecutor(max_workers=1)
+        self._crc_check = pool.submit(self._check_crcs, self.deferred_chunks)
+        pool.shutdown(wait=False)
+
+    def _check_crcs(self, chunks):
+        for number, chunk in chunks:
+            self._check_crc(chunk.type, self.get_chunk_data(chunk),
+                            chunk.crc, number)
+
+    def finish_crc_check(self):
+        """Waits for deferred CRCs and raises the error found, if any,
+        again on every call"""
+        if self._crc_check is not None:
+            self._crc_check.result()
+
+    @contextlib.contextmanager
+    def _checked_decoding(self):
+        """Finishes the deferred CRC check after decoding. A CRC error is
+        raised instead of a decoding error it may have caused."""
+        try:
+            yield
+        except Exception:
+            self.finish_crc_check()
+            raise
+        self.finish_crc_check()
+
+    def _check_crc(self, chunk_type, data, crc, chunk_number=None):
+        start = time.perf_counter()
+        # the running CRC of the type spares a copy of the data
+        counted_crc = zlib.crc32(data, zlib.crc32(chunk_type))
+        if self.stats is not None:
+            self.stats.add('crc', time.perf_counter() - start, len(data))
+        if counted_crc != crc:
+            raise PNGError(
                 'Control sum doesnt match at {} chunk, '
-                'chunk type: {}'.format(self.chunk_count, chunk_type))
+                'chunk type: {}'.format(
+                    self.chunk_count if chunk_number is None
+                    else chunk_number, chunk_type))
@@ -1,25 +1,328 @@
 import sys
 import math
+import time
+import queue
+from array import array
 from PyQt5 import QtWidgets, QtCore, QtGui
-from PyQt5.QtGui import QPainter, QColor, QFont, QBrush
-from PyQt5.QtCore import QSize, QSizeF, QPointF, QRectF, QEvent
+from PyQt5.QtGui import QPainter, QImage
+from PyQt5.QtCore import QSize, QPoint, QRectF
+from .errors import PNGError
+from .lru_cache import LRUCache
 
 PICTURE_AREA_SIZE = QSize(800, 600)
 
+TILE_SIZE = 256
+# default memory budget of rendered tiles in bytes
+TILE_CACHE_SIZE = 64 * 2 ** 20
 
-def show_window(rgb_map, header):
+# seconds between repaints of newly decoded rows
+BAND_INTERVAL = 0.05
+
+# composited animation frames decoded ahead of the shown one
+FRAMES_AHEAD = 4
+# seconds between checks for the next frame or for an interruption
+FRAME_WAIT_INTERVAL = 0.01
+
+# spacing of the pixels known after every Adam7 pass
+ADAM7_GRIDS = ((8, 8), (4, 8), (4, 4), (2, 4), (2, 2), (1, 2), (1, 1))
+
+QIMAGE_FORMATS = {
+    (1, 8): QImage.Format_Grayscale8,
+    (3, 8): QImage.Format_RGB888,
+    (4, 8): QImage.Format_RGBA8888,
+    (1, 16): QImage.Format_Grayscale16,
+    (4, 16): QImage.Format_RGBA64,
+}
+
+
+def show_window(png_image=None, tile_cache_size=TILE_CACHE_SIZE,
+                animation=None, open_reader=None):
     app = QtWidgets.QApplication(sys.argv)
-    png_win = Window(rgb_map, header)
+    png_win = Window(png_image, tile_cache_size, animation, open_reader)
     png_win.show()
     sys.exit(app.exec_())
 
 
+def get_error_message(error):
+    """Returns the message shown for an error raised while decoding"""
+    if isinstance(error, PNGError):
+        return str(error)
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+def get_qimage_layout(png_image):
+    """Returns (channels, bit depth) of the QImage showing an image"""
+    channels = png_image.display_channels
+    bit_depth = 16 if png_image.bit_depth == 16 else 8
+    if bit_depth == 16 and channels == 3:
+        # Qt has no 48-bit format, so opaque alpha is added
+        channels = 4
+    return channels, bit_depth
+
+
+def get_qimage_pixels(png_image, samples=None):
+    """Converts samples (all pixels by default) to the QImage layout"""
+    pixels, channels = png_image.get_display_pixels(samples)
+    if png_image.bit_depth == 16 and channels == 3:
+        rgba = array('H', [0xffff]) * (len(pixels) // 3 * 4)
+        for i in range(3):
+            rgba[i::4] = pixels[i::3]
+        pixels = rgba
+    return pixels
+
+
+def new_qimage_pixels(png_image):
+    """Returns a zeroed buffer for the pixels of an image in the QImage
+    layout"""
+    channels, bit_depth = get_qimage_layout(png_image)
+    return array('H' if bit_depth == 16 else 'B', [0]) * \
+        (png_image.width * png_image.height * channels)
+
+
+def make_qimage(png_image, pixels=None, width=None, height=None):
+    """Wraps pixels in the QImage layout into a QImage without copying.
+
+    Pixels default to the decoded pixels of the whole image.
+    """
+    if pixels is None:
+        pixels = get_qimage_pixels(png_image)
+    width = png_image.width if width is None else width
+    height = png_image.height if height is None else height
+    channels, bit_depth = get_qimage_layout(png_image)
+    return QImage(pixels, width, height, width * channels * bit_depth // 8,
+                  QIMAGE_FORMATS[(channels, bit_depth)])
+
+
+class DecodeThread(QtCore.QThread):
+    """Decodes an image in the background into a QImage pixel buffer.
+
+    Rows of images without interlacing are reported in bands as they
+    are reconstructed. For interlaced images a preview scaled up from
+    the pixels known after each Adam7 pass comes before the full image.
+
+    Without an image, the thread first calls open_reader, which returns
+    a png_reader.Reader created without decoding, allocates the pixel
+    buffer and reports the reader with image_opened, so the file is read
+    and checked on this thread too. Animations are not decoded here.
+    """
+
+    image_opened = QtCore.pyqtSignal(object)
+    rows_decoded = QtCore.pyqtSignal(int, int)
+    pass_decoded = QtCore.pyqtSignal(QImage)
+    decoding_failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, png_image=None, pixels=None, open_reader=None):
+        super().__init__()
+        self.png_image = png_image
+        self.pixels = pixels
+        self.open_reader = open_reader
+
+    def run(self):
+        try:
+            if self.png_image is None:
+                self._open()
+                if self.png_image is None:
+                    return
+            if self.png_image.header.interlace_method:
+                self._decode_passes()
+            else:
+                self._decode_rows()
+        except Exception as e:
+            # an error escaping run() would abort the application
+            self.decoding_failed.emit(get_error_message(e))
+
+    def _open(self):
+        reader = self.open_reader()
+        if reader.animation is None:
+            self.pixels = new_qimage_pixels(reader.image)
+            self.png_image = reader.image
+        self.image_opened.emit(reader)
+
+    def _decode_rows(self):
+        png_image = self.png_image
+        view = memoryview(self.pixels).cast('B')
+        row_size = len(view) // png_image.height
+        first_row = 0
+        band_start = time.monotonic()
+        for y, row in enumerate(png_image.reader.iter_rows()):
+            if self.isInterruptionRequested():
+                return
+            view[y * row_size:(y + 1) * row_size] = memoryview(
+                self._get_row_pixels(row)).cast('B')
+            if time.monotonic() - band_start >= BAND_INTERVAL:
+                self.rows_decoded.emit(first_row, y + 1 - first_row)
+                first_row = y + 1
+                band_start = time.monotonic()
+        self.rows_decoded.emit(first_row, png_image.height - first_row)
+
+    def _decode_passes(self):
+        png_image = self.png_image
+        row_bytes = png_image.reader.row_bytes
+        image_bytes = None
+        for pass_index, image_bytes in png_image.reader.iter_passes():
+            if self.isInterruptionRequested():
+                return
+            if pass_index < len(ADAM7_GRIDS) - 1:
+                self.pass_decoded.emit(
+                    self._get_preview(image_bytes, *ADAM7_GRIDS[pass_index]))
+        if image_bytes is None:
+            return
+
+        view = memoryview(self.pixels).cast('B')
+        row_size = len(view) // png_image.height
+        for y in range(png_image.height):
+            view[y * row_size:(y + 1) * row_size] = memoryview(
+                self._get_row_pixels(
+                    image_bytes[y * row_bytes:(y + 1) * row_bytes])).cast('B')
+        self.rows_decoded.emit(0, png_image.height)
+
+    def _get_row_pixels(self, row):
+        return get_qimage_pixels(
+            self.png_image, self.png_image.get_row_samples(row))
+
+    def _get_preview(self, image_bytes, grid_x, grid_y):
+        """Scales the pixels on a grid_x by grid_y grid up to full size"""
+        png_image = self.png_image
+        row_bytes = png_image.reader.row_bytes
+        channels, bit_depth = get_qimage_layout(png_image)
+        pixel_bytes = channels * bit_depth // 8
+        width = (png_image.width + grid_x - 1) // grid_x
+        height = (png_image.height + grid_y - 1) // grid_y
+        line_bytes = width * pixel_bytes
+
+        pixels = bytearray(line_bytes * height)
+        for i, y in enumerate(range(0, png_image.height, grid_y)):
+            row = memoryview(self._get_row_pixels(
+                image_bytes[y * row_bytes:(y + 1) * row_bytes])).cast('B')
+            start = i * line_bytes
+            for k in range(pixel_bytes):
+                pixels[start + k:start + line_bytes:pixel_bytes] = \
+                    bytes(row[k::grid_x * pixel_bytes])
+        preview = make_qimage(png_image, pixels, width, height)
+        return preview.scaled(width * grid_x, height * grid_y).copy(
+            0, 0, png_image.width, png_image.height)
+
+
+class PlaybackThread(QtCore.QThread):
+    """Composes the frames of an apng.Animation ahead of playback.
+
+    Frames are put as (QImage, delay) into a queue of FRAMES_AHEAD
+    items, so decoding stays a few frames ahead of the shown one instead
+    of decoding the whole animation up front. Frames repeat as many times
+    as the animation plays, forever if num_plays is 0.
+    """
+
+    decoding_failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, animation):
+        super().__init__()
+        self.animation = animation
+        self.frames = queue.Queue(FRAMES_AHEAD)
+
+    def run(self):
+        animation = self.animation
+        plays = 0
+        try:
+            while not animation.num_plays or plays < animation.num_plays:
+                for index in range(len(animation)):
+                    frame = animation.get_frame(index)
+                    qimage = QImage(frame.pixels, frame.width, frame.height,
+                                    frame.width * 4, QImage.Format_RGBA8888)
+                    # the copy owns its pixels
+                    if not self._put((qimage.copy(), frame.delay)):
+                        return
+                plays += 1
+        except Exception as e:
+            self.decoding_failed.emit(get_error_message(e))
+
+    def _put(self, item):
+        while not self.isInterruptionRequested():
+            try:
+                self.frames.put(item, timeout=FRAME_WAIT_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class ImagePyramid:
+    """Full size QImage and its downscaled levels, each half the previous.
+
+    Levels are built on first use, so zooming out reads a small level
+    instead of resampling the full image on every repaint.
+    """
+
+    def __init__(self, qimage):
+        self.levels = [qimage]
+
+    def reset(self):
+        """Drops the downscaled levels after the full image changed"""
+        del self.levels[1:]
+
+    def get_level(self, pixel_size):
+        """Returns (level image, x scale, y scale) to draw at pixel_size"""
+        level = 0
+        while pixel_size <= 0.5 ** (level + 1) and \
+                min(self.levels[level].width(),
+                    self.levels[level].height()) > 1:
+            level += 1
+            if level == len(self.levels):
+                previous = self.levels[-1]
+                self.levels.append(previous.scaled(
+                    max(1, previous.width() // 2),
+                    max(1, previous.height() // 2),
+                    QtCore.Qt.IgnoreAspectRatio,
+                    QtCore.Qt.SmoothTransformation))
+        image = self.levels[level]
+        return (image, image.width() / self.levels[0].width(),
+                image.height() / self.levels[0].height())
+
+
+class TileCache(LRUCache):
+    """LRU cache of rendered tiles, which keeps the last tile even if it
+    is larger than the budget"""
+
+    def __init__(self, max_size=TILE_CACHE_SIZE):
+        super().__init__(max_size, keep_last=True)
+
+    def get_size(self, entry):
+        return entry[0].sizeInBytes()
+
+    def get(self, key):
+        entry = super().get(key)
+        return None if entry is None else entry[0]
+
+    def put(self, key, tile, rows=None):
+        """Stores a tile, optionally with the (first, last) image rows it
+        shows, which discard_rows() checks"""
+        super().put(key, (tile, rows))
+
+    def discard_rows(self, first_row, last_row):
+        """Drops the tiles showing any image row in [first_row, last_row)"""
+        for key, (_, rows) in list(self._entries.items()):
+            if rows is None or (rows[0] < last_row and first_row < rows[1]):
+                self.discard(key)
+
+
 class Window(QtWidgets.QWidget):
-    def __init__(self, rgb_map, meta):
+    """Viewer of a decoded or undecoded image or of an animation.
+
+    Without an image, the window opens at once and the file is opened by
+    calling open_reader on the decoding thread, see DecodeThread.
+    """
+
+    def __init__(self, png_image=None, tile_cache_size=TILE_CACHE_SIZE,
+                 animation=None, open_reader=None):
         super().__init__()
-        self.rgb_map = rgb_map
-        self.bit_depth = meta.bit_depth
-        self.picture_size = QSize(meta.width, meta.height)
+        self.png_image = png_image
+        self.animation = animation
+        self.open_reader = open_reader
+        self.tile_cache_size = tile_cache_size
+        if png_image is None:
+            # an empty picture until the file is opened
+            self.picture_size = QSize(1, 1)
+        else:
+            self.picture_size = QSize(png_image.width, png_image.height)
         self.rescaled_size = self.picture_size
         self.pixel_size = 1
 
@@ -52,6 +355,15 @@ class Window(QtWidgets.QWidget):
 
         self.setWindowTitle('PNG viewer')
 
+    def show_decoding_error(self, message):
+        print(message, file=sys.stderr)
+        self.setWindowTitle('PNG viewer: {}'.format(message))
+
+    def closeEvent(self, event):
+        self.picture.stop_decoding()
+        self.picture.stop_playback()
+        super().closeEvent(event)
+
     def increase_image(self):
         if self.pixel_size >= 4:
             return
@@ -81,8 +393,25 @@ class Picture(QtWidgets.QWidget):
     def __init__(self, window):
         super().__init__()
         self.window = window
-        self.rgb_map = self.window.rgb_map
-        self.bit_depth = self.window.bit_depth
+        self.decode_thread = None
+        self.playback_thread = None
+        png_image = self.window.png_image
+        if png_image is None:
+            self.qimage = self._get_blank_qimage(1, 1)
+            self.start_decoding()
+        elif self.window.animation is not None:
+            # the default image is shown only if it is the first frame
+            self.qimage = self._get_blank_qimage(png_image.width,
+                                                 png_image.height)
+            self.start_playback()
+        elif png_image.pixels is None:
+            self.qimage_pixels = new_qimage_pixels(png_image)
+            self.qimage = make_qimage(png_image, self.qimage_pixels)
+            self.start_decoding()
+        else:
+            self.qimage = make_qimage(png_image)
+        self.pyramid = ImagePyramid(self.qimage)
+        self.tile_cache = TileCache(self.window.tile_cache_size)
         self.picture_size = self.window.picture_size
         self.rescaled_size = self.picture_size
         self.pixel_size = self.window.pixel_size
@@ -147,7 +476,7 @@ class Picture(QtWidgets.QWidget):
             self.horizontal_scroll.setEnabled(True)
             self.setup_scrollbar_dimensions(
                 self.horizontal_scroll,
-                PICTURE_AREA_SIZE.width() // self.pixel_size,
+                int(PICTURE_AREA_SIZE.width() // self.pixel_size),
                 self.picture_size.width())
 
         if self.rescaled_size.height() <= PICTURE_AREA_SIZE.height():
@@ -162,7 +491,7 @@ class Picture(QtWidgets.QWidget):
             self.vertical_scroll.setEnabled(True)
             self.setup_scrollbar_dimensions(
                 self.vertical_scroll,
-                PICTURE_AREA_SIZE.height() // self.pixel_size,
+                int(PICTURE_AREA_SIZE.height() // self.pixel_size),
                 self.picture_size.height())
 
     def setup_scrollbar_dimensions(
@@ -200,29 +529,143 @@ class Picture(QtWidgets.QWidget):
                 PICTURE_AREA_SIZE.height() // self.pixel_size)
 
     def draw_picture(self, qp):
-        size = QSizeF(self.pixel_size, self.pixel_size)
-
-        pixel_width_range = list(
-            range(self.scroll_width_shift,
-                  self.scroll_width_shift + self.width_pixel_count))
-        pixel_height_range = list(
-            range(self.scroll_height_shift,
-                  self.scroll_height_shift + self.height_pixel_count))
-
-        for y in range(self.height_pixel_count):
-            line_index = pixel_height_range[y]
-            line = self.rgb_map[line_index]
-
-            for x in range(self.width_pixel_count):
-                pixel_index = pixel_width_range[x]
-                pixel_color = line[pixel_index]
-                if self.bit_depth == 16:
-                    color = QColor.fromRgba64(*pixel_color)
-                else:
-                    color = QColor(*pixel_color)
-                brush = QBrush(color)
-                left_top = QPointF(
-                    x * self.pixel_size + self.width_central_shift,
-                    y * self.pixel_size + self.height_central_shift)
-                rect = QRectF(left_top, size)
-                qp.fillRect(rect, brush)
+        qp.setClipRect(QRectF(
+            self.width_central_shift, self.height_central_shift,
+            self.width_pixel_count * self.pixel_size,
+            self.height_pixel_count * self.pixel_size))
+
+        level_image, x_scale, y_scale = self.pyramid.get_level(
+            self.pixel_size)
+        # screen size of a tile covering TILE_SIZE pixels of the level
+        tile_width = TILE_SIZE * self.pixel_size / x_scale
+        tile_height = TILE_SIZE * self.pixel_size / y_scale
+
+        left = self.scroll_width_shift * self.pixel_size
+        top = self.scroll_height_shift * self.pixel_size
+        right = left + self.width_pixel_count * self.pixel_size
+        bottom = top + self.height_pixel_count * self.pixel_size
+        x_shift = self.width_central_shift - left
+        y_shift = self.height_central_shift - top
+
+        for tile_y in range(int(top // tile_height),
+                            int(math.ceil(bottom / tile_height))):
+            for tile_x in range(int(left // tile_width),
+                                int(math.ceil(right / tile_width))):
+                qp.drawImage(
+                    QPoint(math.floor(tile_x * tile_width + x_shift),
+                           math.floor(tile_y * tile_height + y_shift)),
+                    self.get_tile(level_image, tile_x, tile_y,
+                                  tile_width, tile_height, y_scale))
+
+    def get_tile(self, level_image, tile_x, tile_y, tile_width, tile_height,
+                 y_scale=1):
+        key = (self.pixel_size, tile_x, tile_y)
+        tile = self.tile_cache.get(key)
+        if tile is None:
+            tile = QImage(int(math.ceil(tile_width)),
+                          int(math.ceil(tile_height)),
+                          QImage.Format_ARGB32_Premultiplied)
+            tile.fill(QtCore.Qt.transparent)
+            qp = QPainter(tile)
+            qp.drawImage(QRectF(0, 0, tile_width, tile_height), level_image,
+                         QRectF(tile_x * TILE_SIZE, tile_y * TILE_SIZE,
+                                TILE_SIZE, TILE_SIZE))
+            qp.end()
+            # smooth downscaling mixes in the level rows next to the tile
+            rows = (math.floor((tile_y * TILE_SIZE - 1) / y_scale),
+                    math.ceil(((tile_y + 1) * TILE_SIZE + 1) / y_scale))
+            self.tile_cache.put(key, tile, rows)
+        return tile
+
+    def _get_blank_qimage(self, width, height):
+        qimage = QImage(width, height, QImage.Format_RGBA8888)
+        qimage.fill(QtCore.Qt.transparent)
+        return qimage
+
+    def start_decoding(self):
+        if self.window.png_image is None:
+            self.decode_thread = DecodeThread(
+                open_reader=self.window.open_reader)
+            self.decode_thread.image_opened.connect(self.show_opened_image)
+        else:
+            self.decode_thread = DecodeThread(self.window.png_image,
+                                              self.qimage_pixels)
+        self.decode_thread.rows_decoded.connect(self.show_rows)
+        self.decode_thread.pass_decoded.connect(self.show_preview)
+        self.decode_thread.decoding_failed.connect(
+            self.window.show_decoding_error)
+        self.decode_thread.start()
+
+    def stop_decoding(self):
+        if self.decode_thread is not None:
+            self.decode_thread.requestInterruption()
+            self.decode_thread.wait()
+
+    def start_playback(self):
+        self.playback_thread = PlaybackThread(self.window.animation)
+        self.playback_thread.decoding_failed.connect(
+            self.window.show_decoding_error)
+        self.frame_timer = QtCore.QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.show_next_frame)
+        self.playback_thread.start()
+        self.frame_timer.start(0)
+
+    def stop_playback(self):
+        if self.playback_thread is not None:
+            self.frame_timer.stop()
+            self.playback_thread.requestInterruption()
+            self.playback_thread.wait()
+
+    def show_next_frame(self):
+        # checked first, so the frames put before finishing are shown
+        finished = self.playback_thread.isFinished()
+        try:
+            qimage, delay = self.playback_thread.frames.get_nowait()
+        except queue.Empty:
+            if not finished:
+                self.frame_timer.start(int(FRAME_WAIT_INTERVAL * 1000))
+            return
+        self.qimage = qimage
+        self.pyramid = ImagePyramid(qimage)
+        self.tile_cache.clear()
+        self.update()
+        self.frame_timer.start(int(delay * 1000))
+
+    def show_rows(self, first_row, row_count):
+        if self.pyramid.levels[0] is not self.qimage:
+            # the full image replaces the interlacing preview
+            self.pyramid = ImagePyramid(self.qimage)
+            self.tile_cache.clear()
+            self.update()
+            return
+        self.pyramid.reset()
+        self.tile_cache.discard_rows(first_row, first_row + row_count)
+        top = (first_row - self.scroll_height_shift) * self.pixel_size + \
+            self.height_central_shift
+        self.update(0, math.floor(top) - 1, PICTURE_AREA_SIZE.width(),
+                    math.ceil(row_count * self.pixel_size) + 2)
+
+    def show_opened_image(self, reader):
+        """Replaces the empty picture once the decoding thread has opened
+        the file"""
+        png_image = reader.image
+        self.window.png_image = png_image
+        self.window.animation = reader.animation
+        self.window.picture_size = QSize(png_image.width, png_image.height)
+        self.picture_size = self.window.picture_size
+        if reader.animation is not None:
+            self.qimage = self._get_blank_qimage(png_image.width,
+                                                 png_image.height)
+            self.start_playback()
+        else:
+            self.qimage_pixels = self.decode_thread.pixels
+            self.qimage = make_qimage(png_image, self.qimage_pixels)
+        self.pyramid = ImagePyramid(self.qimage)
+        self.tile_cache.clear()
+        self.update_picture()
+
+    def show_preview(self, preview):
+        self.pyramid = ImagePyramid(preview)
+        self.tile_cache.clear()
+        self.update()
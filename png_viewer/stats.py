@@ -0,0 +1,89 @@
+import time
+import threading
+import tracemalloc
+import contextlib
+import collections
+
+
+class StageStats:
+    """Totals of one decoding stage"""
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0
+        self.size = 0
+        # None unless tracemalloc was tracing during the stage
+        self.allocated = None
+
+    @property
+    def mb_per_s(self):
+        return self.size / 2 ** 20 / self.time if self.time else 0
+
+
+class DecodeStats:
+    """Wall time, bytes processed and allocations of decoding stages.
+
+    A Reader given a DecodeStats object adds to it while reading and
+    decoding. Callback, if given, is called as callback(stage, seconds,
+    size, allocated) after every measurement. Allocated is the peak of
+    memory traced by tracemalloc during the measurement, so it is only
+    known while tracemalloc is tracing; otherwise it is None.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = collections.OrderedDict()
+        # number of scanlines of every filter type
+        self.filter_rows = collections.Counter()
+        # stages of a pipelined decode add their times from other threads
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, size=0, allocated=None):
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.calls += 1
+            stats.time += seconds
+            stats.size += size
+            if allocated is not None:
+                stats.allocated = max(stats.allocated or 0, allocated)
+        if self.callback is not None:
+            self.callback(stage, seconds, size, allocated)
+
+    @contextlib.contextmanager
+    def measure(self, stage, size=0):
+        """Adds the time and peak allocation of the with block"""
+        # stages are listed in the order they start
+        self.stages.setdefault(stage, StageStats())
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        allocated = None
+        if tracing:
+            allocated = tracemalloc.get_traced_memory()[1] - start_memory
+        self.add(stage, seconds, size, allocated)
+
+    def count_filters(self, filter_types):
+        """Counts scanlines by the filter type bytes given"""
+        self.filter_rows.update(bytes(filter_types))
+
+    def get_report(self):
+        """Returns the stages and filter counts as lines of text"""
+        lines = ['{:<12}{:>10}{:>10}{:>10}{:>14}'.format(
+            'Stage', 'Time, ms', 'MB', 'MB/s', 'Allocated, MB')]
+        for stage, stats in self.stages.items():
+            allocated = '-' if stats.allocated is None \
+                else '{:.2f}'.format(stats.allocated / 2 ** 20)
+            lines.append('{:<12}{:>10.2f}{:>10.2f}{:>10.1f}{:>14}'.format(
+                stage, stats.time * 1000, stats.size / 2 ** 20,
+                stats.mb_per_s, allocated))
+        if self.filter_rows:
+            lines.append('Filter rows: {}'.format(', '.join(
+                '{}: {}'.format(filter_type, count) for filter_type, count
+                in sorted(self.filter_rows.items()))))
+        return lines
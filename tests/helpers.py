@@ -0,0 +1,146 @@
+import os
+import random
+import struct
+import tempfile
+import unittest
+import zlib
+from png_viewer import png_reader
+
+
+def paeth_predictor(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    if pb <= pc:
+        return b
+    return c
+
+
+def filter_rows(rows, filter_unit, filter_types):
+    data = bytearray()
+    previous = bytes(len(rows[0]))
+    for row, filter_type in zip(rows, filter_types):
+        data.append(filter_type)
+        for i, byte in enumerate(row):
+            a = row[i - filter_unit] if i >= filter_unit else 0
+            b = previous[i]
+            c = previous[i - filter_unit] if i >= filter_unit else 0
+            predictor = (0, a, b, (a + b) >> 1,
+                         paeth_predictor(a, b, c))[filter_type]
+            data.append((byte - predictor) % 256)
+        previous = row
+    return bytes(data)
+
+
+def random_rows(width, height, seed=0):
+    rnd = random.Random(seed)
+    return [bytes(rnd.randrange(256) for _ in range(width))
+            for _ in range(height)]
+
+
+def make_chunk(chunk_type, data):
+    return (struct.pack('!L', len(data)) + chunk_type + data +
+            struct.pack('!L', zlib.crc32(chunk_type + data)))
+
+
+def join_chunks(header, chunks):
+    """Builds PNG bytes from a header tuple and the (type, data) pairs of
+    the chunks between IHDR and IEND"""
+    return (bytes(png_reader.PNG_SIGNATURE) +
+            make_chunk(b'IHDR', struct.pack('!LLBBBBB', *header)) +
+            b''.join(make_chunk(chunk_type, data)
+                     for chunk_type, data in chunks) +
+            make_chunk(b'IEND', b''))
+
+
+def interlace_rows(rows, width, pixel_bytes):
+    """Splits rows of whole-byte pixels into non-empty Adam7 passes"""
+    passes = []
+    for x0, y0, dx, dy in png_reader.ADAM7:
+        pass_rows = [b''.join(row[x * pixel_bytes:(x + 1) * pixel_bytes]
+                              for x in range(x0, width, dx))
+                     for row in rows[y0::dy]]
+        if pass_rows and pass_rows[0]:
+            passes.append(pass_rows)
+    return passes
+
+
+def make_png(header, rows, filter_unit, filter_types=None, chunks=(),
+             idat_size=None):
+    """Builds PNG bytes from a header tuple and unfiltered rows"""
+    if filter_types is None:
+        filter_types = [y % 5 for y in range(len(rows))]
+    if header[6]:
+        passes = interlace_rows(rows, header[0], filter_unit)
+    else:
+        passes = [rows]
+    compressed = zlib.compress(b''.join(
+        filter_rows(pass_rows, filter_unit, filter_types)
+        for pass_rows in passes))
+    idat_size = idat_size or len(compressed)
+    return join_chunks(header, list(chunks) + [
+        (b'IDAT', compressed[i:i + idat_size])
+        for i in range(0, len(compressed), idat_size)])
+
+
+def make_apng(width, height, frames, num_plays=0, hidden_default=False):
+    """Builds an RGBA APNG from (x, y, width, height, dispose op, blend op,
+    pixel rows) of every frame"""
+    chunks = [(b'acTL', struct.pack('!LL', len(frames), num_plays))]
+    if hidden_default:
+        chunks.append((b'IDAT', zlib.compress(
+            b''.join(b'\x00' + b'\x00' * width * 4
+                     for _ in range(height)))))
+    sequence_number = 0
+    for i, (x, y, frame_width, frame_height, dispose_op, blend_op,
+            rows) in enumerate(frames):
+        chunks.append((b'fcTL', struct.pack(
+            '!LLLLLHHBB', sequence_number, frame_width, frame_height, x, y,
+            1, 10, dispose_op, blend_op)))
+        sequence_number += 1
+        data = zlib.compress(b''.join(b'\x00' + row for row in rows))
+        if i == 0 and not hidden_default:
+            chunks.append((b'IDAT', data))
+        else:
+            chunks.append(
+                (b'fdAT', struct.pack('!L', sequence_number) + data))
+            sequence_number += 1
+    return join_chunks((width, height, 8, 6, 0, 0, 0), chunks)
+
+
+RED = b'\xff\x00\x00\xff'
+BLUE = b'\x00\x00\xff\xff'
+CLEAR = b'\x00\x00\x00\x00'
+
+
+class ShortReadStream:
+    """Non-seekable stream returning at most size bytes per read"""
+
+    def __init__(self, data, size, on_read=None):
+        self.data = data
+        self.size = size
+        self.offset = 0
+        self.on_read = on_read
+
+    def read(self, size=-1):
+        if self.on_read is not None:
+            self.on_read(self.offset)
+        piece = self.data[self.offset:self.offset + min(size, self.size)]
+        self.offset += len(piece)
+        return piece
+
+
+class PNGFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def write_file(self, data, name='test.png'):
+        file_name = os.path.join(self.temp_dir.name, name)
+        with open(file_name, 'wb') as f:
+            f.write(data)
+        return file_name
+
+    def write_png(self, *args, **kwargs):
+        return self.write_file(make_png(*args, **kwargs))
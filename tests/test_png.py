@@ -1,15 +1,34 @@
 import unittest
+import array
+import contextlib
+import io
+import gc
 import sys
 import os
 import random
 import struct
+import threading
+import zlib
 from unittest.mock import patch
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              os.path.pardir))
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              os.path.pardir, 'png_viewer'))
-from png_viewer import png_reader, image
+from png_viewer import png_reader, image, filters, batch, stats, disk_cache
+from png_viewer import image_cache, lru_cache, pipeline, apng
+import benchmark
+import check_correcteness
+from helpers import (PNGFileTestCase, ShortReadStream, RED, BLUE, CLEAR,
+                     filter_rows, join_chunks, make_apng, make_png,
+                     random_rows)
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+try:
+    from PyQt5 import QtWidgets
+    from png_viewer import png_window
+except ImportError:
+    png_window = None
 
 
 class PNGReaderTests(unittest.TestCase):
@@ -92,5 +111,1105 @@ class PNGReaderTests(unittest.TestCase):
         self.assertTrue(True)
 
 
+class FilterTests(unittest.TestCase):
+    def _get_reader(self, row_bytes, bytes_per_pixel):
+        reader = png_reader.Reader.__new__(png_reader.Reader)
+        reader.row_bytes = row_bytes
+        reader.bytes_per_pixel = bytes_per_pixel
+        return reader
+
+    def _check_filters(self, filter_unit):
+        rows = random_rows(filter_unit * 7, 12, seed=filter_unit)
+        filter_types = [0, 1, 2, 3, 4, 1, 3, 4, 2, 4, 3, 0]
+        data = filter_rows(rows, filter_unit, filter_types)
+        reader = self._get_reader(len(rows[0]), filter_unit)
+        self.assertEqual(reader._undo_filter(data), b''.join(rows))
+        with patch.object(filters, 'numpy', None):
+            self.assertEqual(reader._undo_filter(data), b''.join(rows))
+
+    def test_undo_filter_one_byte_per_pixel(self):
+        self._check_filters(1)
+
+    def test_undo_filter_rgba(self):
+        self._check_filters(4)
+
+    def test_undo_filter_rgba_16(self):
+        self._check_filters(8)
+
+    @unittest.skipIf(filters.numpy is None, 'NumPy is not installed')
+    def test_numpy_engine_is_default(self):
+        self.assertIsInstance(filters.get_engine(8, 1), filters.NumpyEngine)
+
+    @unittest.skipIf(filters.numpy is None, 'NumPy is not installed')
+    def test_numpy_average_and_paeth(self):
+        for unit in (1, 2, 3, 6):
+            rows = random_rows(unit * 5, 3, seed=unit)
+            python_engine = filters.PythonEngine(len(rows[0]), unit)
+            numpy_engine = filters.NumpyEngine(len(rows[0]), unit)
+            for filter_type in (3, 4):
+                for previous in (None, rows[0]):
+                    with self.subTest(unit=unit, filter_type=filter_type,
+                                      previous=previous is not None):
+                        self.assertEqual(
+                            numpy_engine.unfilter_row(filter_type, rows[1],
+                                                      previous),
+                            python_engine.unfilter_row(filter_type, rows[1],
+                                                       previous))
+
+    def test_python_engine_without_numpy(self):
+        with patch.object(filters, 'numpy', None):
+            self.assertIsInstance(
+                filters.get_engine(8, 1), filters.PythonEngine)
+
+    def test_unknown_filter(self):
+        reader = self._get_reader(2, 1)
+        self.assertRaises(png_reader.PNGError, reader._undo_filter,
+                          b'\x05\x00\x00')
+
+
+class StreamingTests(PNGFileTestCase):
+    def _check_rows(self, width, height, idat_size):
+        rows = random_rows(width * 4, height, seed=height)
+        file_name = self.write_png((width, height, 8, 6, 0, 0, 0), rows, 4,
+                                   idat_size=idat_size)
+        reader = png_reader.Reader(file_name, True)
+        self.assertEqual([bytes(row) for row in reader.iter_rows()], rows)
+        with patch.object(filters, 'numpy', None):
+            self.assertEqual([bytes(row) for row in reader.iter_rows()], rows)
+
+    def test_iter_rows_many_idat_chunks(self):
+        self._check_rows(5, 9, 7)
+
+    def test_iter_rows_larger_than_inflate_chunk(self):
+        with patch.object(png_reader, 'INFLATE_CHUNK_SIZE', 64):
+            self._check_rows(40, 20, 100)
+
+    def test_iter_rows_is_lazy(self):
+        rows = random_rows(8, 3)
+        file_name = self.write_png((2, 3, 8, 6, 0, 0, 0), rows, 4)
+        reader = png_reader.Reader(file_name, True)
+        self.assertEqual(bytes(next(reader.iter_rows())), rows[0])
+        self.assertIsNone(reader.image.pixels)
+        self.assertEqual(reader.image.bit_map, [])
+
+
+class ChunkIndexTests(PNGFileTestCase):
+    def test_chunk_index(self):
+        rows = random_rows(6, 4)
+        file_name = self.write_png((2, 4, 8, 2, 0, 0, 0), rows, 3,
+                                   chunks=[(b'tEXt', b'a\x00b')])
+        reader = png_reader.Reader(file_name, True)
+        self.assertEqual([chunk.type for chunk in reader.chunk_index],
+                         [b'IHDR', b'tEXt', b'IDAT', b'IEND'])
+        text_chunk = reader.chunk_index[1]
+        self.assertEqual(text_chunk.offset, 8 + 25 + 8)
+        self.assertEqual(text_chunk.length, 3)
+        self.assertEqual(text_chunk.crc, zlib.crc32(b'tEXta\x00b'))
+
+    def test_chunk_data_is_view(self):
+        rows = random_rows(6, 4)
+        file_name = self.write_png((2, 4, 8, 2, 0, 0, 0), rows, 3)
+        reader = png_reader.Reader(file_name)
+        self.assertIsInstance(reader.idat_list[0], memoryview)
+        self.assertEqual([bytes(row) for row in reader.image.bit_map], rows)
+
+    def test_truncated_file(self):
+        file_name = self.write_png((2, 4, 8, 2, 0, 0, 0), random_rows(6, 4),
+                                   3)
+        with open(file_name, 'r+b') as f:
+            f.truncate(os.path.getsize(file_name) - 6)
+        with self.assertRaises(png_reader.PNGError) as context:
+            png_reader.Reader(file_name)
+        self.assertEqual(str(context.exception), 'No IEND chunk')
+
+
+class ProbeTests(PNGFileTestCase):
+    def test_probe_header(self):
+        file_name = self.write_png((3, 4, 8, 2, 0, 0, 0), random_rows(9, 4),
+                                   3)
+        probe = png_reader.Probe(file_name)
+        self.assertEqual(probe.header.get_info(),
+                         png_reader.Reader(file_name, True).header.get_info())
+        self.assertEqual(len(probe.chunk_index), 1)
+
+    def test_probe_walk_chunks(self):
+        file_name = self.write_png((3, 4, 8, 2, 0, 0, 0), random_rows(9, 4),
+                                   3, chunks=[(b'tEXt', b'a\x00b')],
+                                   idat_size=10)
+        probe = png_reader.Probe(file_name, walk_chunks=True)
+        self.assertEqual(probe.chunk_index,
+                         png_reader.Reader(file_name, True).chunk_index)
+
+    def test_probe_does_not_read_payloads(self):
+        file_name = self.write_png((3, 4, 8, 2, 0, 0, 0), random_rows(9, 4),
+                                   3)
+        with open(file_name, 'r+b') as f:
+            f.truncate(40)
+        probe = png_reader.Probe(file_name)
+        self.assertEqual(probe.header.width, 3)
+
+
+class InterlaceTests(PNGFileTestCase):
+    def _check_interlaced(self, width, height, bit_depth, color_type,
+                          pixel_bytes):
+        rows = random_rows(width * pixel_bytes, height, seed=width)
+        file_name = self.write_png(
+            (width, height, bit_depth, color_type, 0, 0, 1), rows,
+            pixel_bytes, idat_size=16)
+        reader = png_reader.Reader(file_name, True)
+        self.assertEqual([bytes(row) for row in reader.iter_rows()], rows)
+        with patch.object(filters, 'numpy', None):
+            self.assertEqual([bytes(row) for row in reader.iter_rows()],
+                             rows)
+        return file_name, rows
+
+    def test_interlaced_grayscale(self):
+        file_name, rows = self._check_interlaced(13, 11, 8, 0, 1)
+        reader = png_reader.Reader(file_name)
+        self.assertEqual([bytes(row) for row in reader.image.bit_map], rows)
+
+    def test_interlaced_truecolor_with_alpha(self):
+        self._check_interlaced(9, 17, 8, 6, 4)
+
+    def test_interlaced_truecolor_16(self):
+        self._check_interlaced(10, 3, 16, 2, 6)
+
+    def test_interlaced_smaller_than_pass(self):
+        self._check_interlaced(1, 1, 8, 2, 3)
+
+    def test_passes_are_progressive(self):
+        rows = random_rows(16, 16)
+        file_name = self.write_png((16, 16, 8, 0, 0, 0, 1), rows, 1)
+        reader = png_reader.Reader(file_name, True)
+        passes = [(pass_index, bytes(image_bytes))
+                  for pass_index, image_bytes in reader.iter_passes()]
+        self.assertEqual([pass_index for pass_index, _ in passes],
+                         list(range(7)))
+        first_pass = passes[0][1]
+        self.assertEqual(first_pass[0], rows[0][0])
+        self.assertEqual(first_pass[8 * 16 + 8], rows[8][8])
+        self.assertEqual(first_pass[1], 0)
+        self.assertEqual(passes[-1][1], b''.join(rows))
+
+    def test_not_interlaced_single_pass(self):
+        rows = random_rows(4, 5)
+        file_name = self.write_png((4, 5, 8, 0, 0, 0, 0), rows, 1)
+        reader = png_reader.Reader(file_name, True)
+        self.assertEqual([(pass_index, bytes(image_bytes)) for
+                          pass_index, image_bytes in reader.iter_passes()],
+                         [(0, b''.join(rows))])
+
+
+class ImageBufferTests(PNGFileTestCase):
+    def test_contiguous_pixels(self):
+        rows = random_rows(12, 5)
+        file_name = self.write_png((3, 5, 8, 6, 0, 0, 0), rows, 4)
+        png_image = png_reader.Reader(file_name).image
+        self.assertEqual((png_image.width, png_image.height,
+                          png_image.channels, png_image.stride),
+                         (3, 5, 4, 12))
+        self.assertEqual(png_image.pixels.tobytes(), b''.join(rows))
+        self.assertEqual(bytes(png_image.get_buffer()), b''.join(rows))
+        self.assertEqual([row.tobytes() for row in png_image.bit_map], rows)
+
+    def test_rgb_representation_view(self):
+        rows = random_rows(6, 2)
+        file_name = self.write_png((2, 2, 8, 2, 0, 0, 0), rows, 3)
+        png_image = png_reader.Reader(file_name).image
+        self.assertEqual(
+            [[tuple(pixel) for pixel in line]
+             for line in png_image.rgb_representation()],
+            [[tuple(row[0:3]), tuple(row[3:6])] for row in rows])
+
+    @unittest.skipIf(image.numpy is None, 'NumPy is not installed')
+    def test_numpy_view(self):
+        rows = random_rows(12, 5)
+        file_name = self.write_png((3, 5, 8, 6, 0, 0, 0), rows, 4)
+        pixels = png_reader.Reader(file_name).image.as_array()
+        self.assertEqual(pixels.shape, (5, 3, 4))
+        self.assertEqual(pixels[4, 2].tolist(), list(rows[4][8:12]))
+
+
+class SampleUnpackTests(PNGFileTestCase):
+    def _check_unpack(self, bit_depth, width):
+        rnd = random.Random(bit_depth)
+        samples = [[rnd.randrange(2 ** bit_depth) for _ in range(width)]
+                   for _ in range(3)]
+        rows = []
+        for row_samples in samples:
+            bits = ''.join('{:0{}b}'.format(sample, bit_depth)
+                           for sample in row_samples)
+            bits += '0' * (-len(bits) % 8)
+            rows.append(bytes(int(bits[i:i + 8], 2)
+                              for i in range(0, len(bits), 8)))
+        file_name = self.write_png((width, 3, bit_depth, 0, 0, 0, 0), rows, 1)
+        png_image = png_reader.Reader(file_name).image
+        self.assertEqual(png_image.stride, width)
+        self.assertEqual([row.tolist() for row in png_image.bit_map], samples)
+
+    def test_unpack_1_bit(self):
+        self._check_unpack(1, 13)
+
+    def test_unpack_2_bit(self):
+        self._check_unpack(2, 7)
+
+    def test_unpack_4_bit(self):
+        self._check_unpack(4, 5)
+
+    def test_sample_tables(self):
+        self.assertEqual([table[0b10110100] for table in
+                          image.SAMPLE_TABLES[2]], [2, 3, 1, 0])
+
+
+class SixteenBitTests(PNGFileTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rows = random_rows(12, 4)
+        self.samples = [list(struct.unpack('!6H', row)) for row in self.rows]
+        self.file_name = self.write_png((2, 4, 16, 2, 0, 0, 0), self.rows, 6)
+
+    def test_16_bit_samples(self):
+        png_image = png_reader.Reader(self.file_name).image
+        self.assertEqual(png_image.pixels.typecode, 'H')
+        self.assertEqual([row.tolist() for row in png_image.bit_map],
+                         self.samples)
+        self.assertEqual(png_image.get_8bit_pixels().tolist(),
+                         [sample >> 8 for row in self.samples
+                          for sample in row])
+
+    def test_decode_to_8_bit(self):
+        png_image = png_reader.Reader(self.file_name, to_8bit=True).image
+        self.assertEqual(png_image.bit_depth, 8)
+        self.assertEqual(png_image.pixels.typecode, 'B')
+        self.assertEqual([row.tolist() for row in png_image.bit_map],
+                         [[sample >> 8 for sample in row]
+                          for row in self.samples])
+
+
+class PaletteTests(PNGFileTestCase):
+    PALETTE = b'\x00\x00\x00\xff\x00\x00\x00\xff\x00'
+    ROWS = [b'\x00\x01', b'\x02\x01']
+
+    def test_indexed_colors(self):
+        file_name = self.write_png((2, 2, 8, 3, 0, 0, 0), self.ROWS, 1,
+                                   chunks=[(b'PLTE', self.PALETTE)])
+        reader = png_reader.Reader(file_name)
+        self.assertEqual(reader.palette_channels, 3)
+        self.assertEqual(len(reader.palette), 256 * 3)
+        self.assertEqual(bytes(reader.image.expand_palette()),
+                         self.PALETTE[0:6] + self.PALETTE[6:9] +
+                         self.PALETTE[3:6])
+        self.assertEqual(reader.image.rgb_representation()[1],
+                         [b'\x00\xff\x00', b'\xff\x00\x00'])
+
+    def test_indexed_colors_with_transparency(self):
+        file_name = self.write_png((2, 2, 8, 3, 0, 0, 0), self.ROWS, 1,
+                                   chunks=[(b'PLTE', self.PALETTE),
+                                           (b'tRNS', b'\x00\x80')])
+        reader = png_reader.Reader(file_name)
+        self.assertEqual(reader.palette_channels, 4)
+        self.assertEqual(reader.image.rgb_representation(),
+                         [[b'\x00\x00\x00\x00', b'\xff\x00\x00\x80'],
+                          [b'\x00\xff\x00\xff', b'\xff\x00\x00\x80']])
+
+    def test_transparency_before_palette(self):
+        file_name = self.write_png((2, 2, 8, 3, 0, 0, 0), self.ROWS, 1,
+                                   chunks=[(b'tRNS', b'\x00'),
+                                           (b'PLTE', self.PALETTE)])
+        self.assertRaises(png_reader.PNGError, png_reader.Reader, file_name)
+
+
+@unittest.skipIf(png_window is None, 'PyQt5 is not installed')
+class WindowTests(PNGFileTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtWidgets.QApplication.instance() or \
+            QtWidgets.QApplication([])
+
+    def _get_colors(self, qimage):
+        return [[qimage.pixelColor(x, y).getRgb()
+                 for x in range(qimage.width())]
+                for y in range(qimage.height())]
+
+    def test_truecolor_qimage(self):
+        rows = random_rows(6, 2)
+        file_name = self.write_png((2, 2, 8, 2, 0, 0, 0), rows, 3)
+        qimage = png_window.make_qimage(png_reader.Reader(file_name).image)
+        self.assertEqual(self._get_colors(qimage),
+                         [[tuple(row[0:3]) + (255,), tuple(row[3:6]) + (255,)]
+                          for row in rows])
+
+    def test_grayscale_with_alpha_qimage(self):
+        file_name = self.write_png((2, 1, 8, 4, 0, 0, 0),
+                                   [b'\x10\x20\x30\x40'], 2)
+        qimage = png_window.make_qimage(png_reader.Reader(file_name).image)
+        self.assertEqual(self._get_colors(qimage),
+                         [[(16, 16, 16, 32), (48, 48, 48, 64)]])
+
+    def test_truecolor_16_qimage(self):
+        rows = [struct.pack('!3H', 0x1234, 0x5678, 0x9abc)]
+        file_name = self.write_png((1, 1, 16, 2, 0, 0, 0), rows, 6)
+        qimage = png_window.make_qimage(png_reader.Reader(file_name).image)
+        self.assertEqual(qimage.format(), png_window.QImage.Format_RGBA64)
+        color = qimage.pixelColor(0, 0).rgba64()
+        self.assertEqual((color.red(), color.green(), color.blue(),
+                          color.alpha()), (0x1234, 0x5678, 0x9abc, 0xffff))
+
+    def test_playback_thread(self):
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [RED]),
+                                (0, 0, 1, 1, 0, 0, [BLUE])], num_plays=1)
+        thread = png_window.PlaybackThread(
+            png_reader.Reader(data, True).animation)
+        thread.start()
+        self.assertTrue(thread.wait(5000))
+        colors = []
+        while not thread.frames.empty():
+            qimage, delay = thread.frames.get()
+            colors.append(qimage.pixelColor(0, 0).getRgb())
+        self.assertEqual(colors, [(255, 0, 0, 255), (0, 0, 255, 255)])
+
+    def test_thread_errors(self):
+        file_name = self.write_png((3, 2, 8, 0, 0, 0, 0), random_rows(3, 2), 1)
+        png_image = png_reader.Reader(file_name, True).image
+        thread = png_window.DecodeThread(png_image, bytearray(6))
+        errors = []
+        thread.decoding_failed.connect(errors.append,
+                                       png_window.QtCore.Qt.DirectConnection)
+        with patch.object(png_image.reader, 'iter_rows',
+                          side_effect=MemoryError('no memory')):
+            thread.run()
+        self.assertEqual(errors, ['MemoryError: no memory'])
+
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [RED]),
+                                (0, 0, 1, 1, 0, 0, [BLUE])])
+        animation = png_reader.Reader(data, True).animation
+        thread = png_window.PlaybackThread(animation)
+        thread.decoding_failed.connect(errors.append,
+                                       png_window.QtCore.Qt.DirectConnection)
+        with patch.object(animation, 'get_frame',
+                          side_effect=png_reader.PNGError('Incorrect frame')):
+            thread.run()
+        self.assertEqual(errors[1:], ['Incorrect frame'])
+
+    def test_window_opens_reader(self):
+        rows = random_rows(6, 3)
+        data = make_png((2, 3, 8, 2, 0, 0, 0), rows, 3, idat_size=10)
+        window = png_window.Window(open_reader=lambda: png_reader.Reader(
+            ShortReadStream(data, 7), True, integrity='deferred', lazy=True))
+        self.assertIsNone(window.png_image)
+        self.assertTrue(window.picture.decode_thread.wait(5000))
+        self.app.processEvents()
+        self.assertEqual((window.picture_size.width(),
+                          window.picture_size.height()), (2, 3))
+        self.assertEqual(self._get_colors(window.picture.qimage),
+                         [[tuple(row[0:3]) + (255,), tuple(row[3:6]) + (255,)]
+                          for row in rows])
+        window.close()
+
+    def test_pyramid_levels(self):
+        qimage = png_window.QImage(40, 30, png_window.QImage.Format_RGB888)
+        pyramid = png_window.ImagePyramid(qimage)
+        self.assertIs(pyramid.get_level(0.75)[0], qimage)
+        level_image, x_scale, y_scale = pyramid.get_level(0.25)
+        self.assertEqual((level_image.width(), level_image.height()),
+                         (10, 7))
+        self.assertEqual((x_scale, y_scale), (0.25, 7 / 30))
+        self.assertEqual(len(pyramid.levels), 3)
+
+    def test_tile_cache_budget(self):
+        tile = png_window.QImage(4, 4, png_window.QImage.Format_RGB32)
+        cache = png_window.TileCache(tile.sizeInBytes() * 2)
+        cache.put('a', tile)
+        cache.put('b', tile)
+        cache.get('a')
+        cache.put('c', tile)
+        self.assertIsNone(cache.get('b'))
+        self.assertIs(cache.get('a'), tile)
+        self.assertEqual(cache.size, tile.sizeInBytes() * 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_scrolling_reuses_tiles(self):
+        rows = random_rows(3000, 10)
+        file_name = self.write_png((1000, 10, 8, 2, 0, 0, 0), rows, 3,
+                                   filter_types=[0] * 10)
+        window = png_window.Window(png_reader.Reader(file_name).image)
+        picture = window.picture
+        picture.grab()
+        misses = picture.tile_cache.misses
+        picture.horizontal_scroll.setValue(10)
+        picture.grab()
+        self.assertEqual(picture.tile_cache.misses, misses)
+        self.assertGreater(picture.tile_cache.hits, 0)
+
+    def test_window_paints(self):
+        rows = random_rows(30, 20)
+        file_name = self.write_png((10, 20, 8, 2, 0, 0, 0), rows, 3)
+        window = png_window.Window(png_reader.Reader(file_name).image)
+        window.increase_image()
+        self.assertFalse(window.picture.grab().isNull())
+
+    def test_tile_cache_discards_rows(self):
+        tile = png_window.QImage(4, 4, png_window.QImage.Format_RGB32)
+        cache = png_window.TileCache()
+        cache.put('top', tile, (0, 10))
+        cache.put('bottom', tile, (10, 20))
+        cache.discard_rows(12, 15)
+        self.assertIs(cache.get('top'), tile)
+        self.assertIsNone(cache.get('bottom'))
+        self.assertEqual(cache.size, tile.sizeInBytes())
+
+    def test_background_decoding(self):
+        rows = random_rows(30, 20)
+        file_name = self.write_png((10, 20, 8, 2, 0, 0, 0), rows, 3)
+        expected = png_window.make_qimage(png_reader.Reader(file_name).image)
+        window = png_window.Window(png_reader.Reader(file_name, True).image)
+        window.picture.decode_thread.wait()
+        self.app.processEvents()
+        self.assertEqual(window.picture.qimage, expected)
+        window.close()
+
+    def test_interlaced_previews(self):
+        rows = random_rows(27, 9)
+        file_name = self.write_png((9, 9, 8, 2, 0, 0, 1), rows, 3)
+        png_image = png_reader.Reader(file_name, True).image
+        channels, _ = png_window.get_qimage_layout(png_image)
+        pixels = bytearray(9 * 9 * channels)
+        thread = png_window.DecodeThread(png_image, pixels)
+        previews = []
+        thread.pass_decoded.connect(previews.append,
+                                    png_window.QtCore.Qt.DirectConnection)
+        thread.run()
+        self.assertEqual(len(previews), 6)
+        # after the first pass every 8 by 8 block shows its top left pixel
+        self.assertEqual(self._get_colors(previews[0])[7][7],
+                         tuple(rows[0][0:3]) + (255,))
+        self.assertEqual(bytes(pixels), b''.join(rows))
+
+
+class BatchTests(PNGFileTestCase):
+    def test_find_files(self):
+        good = self.write_png((1, 1, 8, 0, 0, 0, 0), [b'\x00'], 1)
+        os.mkdir(os.path.join(self.temp_dir.name, 'sub'))
+        nested = os.path.join(self.temp_dir.name, 'sub', 'nested.PNG')
+        open(nested, 'wb').close()
+        self.assertEqual(batch.find_files([self.temp_dir.name]),
+                         [good, nested])
+        self.assertEqual(
+            batch.find_files([os.path.join(self.temp_dir.name, '*.png')]),
+            [good])
+
+    def test_records(self):
+        good = self.write_png((2, 1, 8, 0, 0, 0, 0), [b'\x00\x01'], 1)
+        bad = self.write_file(b'not a png', 'bad.png')
+        missing = os.path.join(self.temp_dir.name, 'missing.png')
+        records = list(batch.decode_files([good, bad, missing], jobs=2))
+        self.assertEqual([record['file'] for record in records],
+                         [good, bad, missing])
+        self.assertEqual(records[0]['header']['width'], 2)
+        self.assertIsNone(records[0]['error'])
+        self.assertTrue(records[1]['error'].startswith(
+            'Incorrect PNG signature'))
+        self.assertTrue(records[2]['error'].startswith('FileNotFoundError'))
+
+
+class CheckCorrectnessTests(PNGFileTestCase):
+    def test_in_process_run(self):
+        good = self.write_file(
+            make_png((1, 1, 8, 0, 0, 0, 0), [b'\x00'], 1), 'a.png')
+        expected = self.write_file(b'not a png', 'b.png')
+        unexpected = os.path.join(self.temp_dir.name, 'c.png')
+        # a dangling link fails with an error the decoder does not report
+        os.symlink(os.path.join(self.temp_dir.name, 'missing'), unexpected)
+        output = io.StringIO()
+        argv = ['check_correcteness.py', self.temp_dir.name, '-j', '1']
+        with patch.object(sys, 'argv', argv), \
+                contextlib.redirect_stdout(output), \
+                self.assertRaises(SystemExit) as context:
+            check_correcteness.main()
+        self.assertEqual(context.exception.code, 1)
+
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('1 / 3 {} '.format(good)))
+        self.assertTrue(lines[0].endswith('s ok'))
+        self.assertTrue(lines[1].startswith('2 / 3 {} '.format(expected)))
+        self.assertIn('s expected error: Incorrect PNG signature', lines[1])
+        self.assertTrue(lines[2].startswith('3 / 3 {} '.format(unexpected)))
+        self.assertIn('s UNEXPECTED ERROR: FileNotFoundError', lines[2])
+        self.assertEqual(lines[3], 'error count: 1 / 3')
+        self.assertTrue(lines[4].startswith('decode time: '))
+        self.assertTrue(lines[5].startswith('wall time: '))
+
+    def test_exit_status_without_errors(self):
+        self.write_file(make_png((1, 1, 8, 0, 0, 0, 0), [b'\x00'], 1),
+                        'a.png')
+        self.write_file(b'not a png', 'b.png')
+        argv = ['check_correcteness.py', self.temp_dir.name, '-j', '1']
+        with patch.object(sys, 'argv', argv), \
+                contextlib.redirect_stdout(io.StringIO()), \
+                self.assertRaises(SystemExit) as context:
+            check_correcteness.main()
+        self.assertEqual(context.exception.code, 0)
+
+
+@unittest.skipIf(benchmark.numpy is None, 'NumPy is not installed')
+class BenchmarkTests(PNGFileTestCase):
+    def test_cases(self):
+        self.assertEqual(
+            [case[2:] for case in benchmark.get_cases(['thumb'], [3],
+                                                      None, [0])],
+            [(1, 0, 2), (2, 0, 2), (2, 0, 4), (4, 0, 2), (4, 0, 16),
+             (8, 0, 2), (8, 0, 16), (8, 0, 256)])
+        self.assertEqual(
+            list(benchmark.get_cases(['thumb', 'vga'], [2], [16], [1, 4])),
+            [('thumb', 2, 16, 1, None), ('thumb', 2, 16, 4, None),
+             ('vga', 2, 16, 1, None), ('vga', 2, 16, 4, None)])
+
+    def test_generated_images(self):
+        for bit_depth, color_type, palette_size in (
+                (8, 2, None), (16, 6, None), (1, 0, None), (2, 3, 4)):
+            samples = benchmark.make_samples(
+                5, 4, benchmark.CHANNELS[color_type], bit_depth,
+                palette_size,
+                benchmark.numpy.random.default_rng(5 * 4 + bit_depth), 0, 4)
+            for filter_type in filters.FILTER_TYPES:
+                with self.subTest(bit_depth=bit_depth,
+                                  color_type=color_type,
+                                  filter_type=filter_type):
+                    reader = png_reader.Reader(benchmark.make_png(
+                        5, 4, bit_depth, color_type, filter_type,
+                        palette_size))
+                    self.assertEqual(list(reader.image.pixels),
+                                     samples.ravel().tolist())
+
+    def test_measure_thumbnail(self):
+        file_name = self.write_file(
+            benchmark.make_png(*benchmark.SIZES['thumb'], 8, 2, 4))
+        result = benchmark.measure(file_name, 1)
+        self.assertEqual(list(result), list(benchmark.STAGES))
+        for stage in benchmark.STAGES:
+            self.assertGreater(result[stage]['mb_per_s'], 0)
+            self.assertGreaterEqual(result[stage]['peak_mb'], 0)
+
+
+class StatsTests(PNGFileTestCase):
+    def test_stage_stats(self):
+        rows = random_rows(6, 5)
+        file_name = self.write_png((2, 5, 8, 2, 0, 0, 0), rows, 3,
+                                   filter_types=[0, 1, 4, 4, 2])
+        calls = []
+        decode_stats = stats.DecodeStats(
+            lambda *args: calls.append(args[0]))
+        png_reader.Reader(file_name, stats=decode_stats)
+        self.assertEqual(list(decode_stats.stages),
+                         ['read', 'crc', 'inflate', 'unfilter', 'unpack'])
+        self.assertEqual(decode_stats.stages['unpack'].size, 30)
+        self.assertEqual(decode_stats.stages['read'].size,
+                         os.path.getsize(file_name))
+        self.assertEqual(decode_stats.filter_rows, {0: 1, 1: 1, 2: 1, 4: 2})
+        self.assertEqual(set(calls), set(decode_stats.stages))
+
+    def test_interlaced_stages(self):
+        file_name = self.write_png((3, 3, 8, 0, 0, 0, 1), random_rows(3, 3),
+                                   1)
+        decode_stats = stats.DecodeStats()
+        png_reader.Reader(file_name, stats=decode_stats)
+        self.assertIn('deinterlace', decode_stats.stages)
+        self.assertEqual(sum(decode_stats.filter_rows.values()), 6)
+
+
+class DiskCacheTests(PNGFileTestCase):
+    def test_reload(self):
+        rows = [struct.pack('!2H', 0x1234, 0xabcd)]
+        file_name = self.write_png((2, 1, 16, 0, 0, 0, 0), rows, 2)
+        cache = disk_cache.DiskCache(
+            os.path.join(self.temp_dir.name, 'cache'))
+        decoded = png_reader.Reader(file_name, cache=cache).image.pixels
+        cached = png_reader.Reader(file_name, cache=cache).image.pixels
+        self.assertEqual(cached, decoded)
+        self.assertEqual(cached, array.array('H', [0x1234, 0xabcd]))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_changed_file(self):
+        cache = disk_cache.DiskCache(
+            os.path.join(self.temp_dir.name, 'cache'))
+        file_name = self.write_png((1, 1, 8, 0, 0, 0, 0), [b'\x01'], 1)
+        png_reader.Reader(file_name, cache=cache)
+        file_name = self.write_png((1, 1, 8, 0, 0, 0, 0), [b'\x02'], 1)
+        reader = png_reader.Reader(file_name, cache=cache)
+        self.assertEqual(list(reader.image.pixels), [2])
+        self.assertEqual(cache.hits, 0)
+
+    def test_eviction(self):
+        directory = os.path.join(self.temp_dir.name, 'cache')
+        cache = disk_cache.DiskCache(directory, max_size=150)
+        for i in range(3):
+            file_name = self.write_file(
+                make_png((10, 10, 8, 0, 0, 0, 0),
+                         random_rows(10, 10, seed=i), 1),
+                '{}.png'.format(i))
+            png_reader.Reader(file_name, cache=cache)
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_unique_temporary_files(self):
+        directory = os.path.join(self.temp_dir.name, 'cache')
+        cache = disk_cache.DiskCache(directory)
+        file_name = self.write_png((1, 1, 8, 0, 0, 0, 0), [b'\x01'], 1)
+        reader = png_reader.Reader(file_name)
+        with patch.object(os, 'replace', wraps=os.replace) as replace:
+            cache.store(reader)
+            cache.store(reader)
+        # writers of the same entry never share a temporary file
+        temp_names = [call.args[0] for call in replace.call_args_list]
+        self.assertEqual(len(set(temp_names)), 4)
+        self.assertFalse([name for name in os.listdir(directory)
+                          if name.endswith('.tmp')])
+        self.assertEqual(
+            list(png_reader.Reader(file_name, cache=cache).image.pixels), [1])
+        self.assertEqual(cache.hits, 1)
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_oversized_value_replaces_entry(self):
+        cache = lru_cache.LRUCache(4)
+        cache.put('key', b'old')
+        cache.put('key', b'too large')
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class ImageCacheTests(PNGFileTestCase):
+    def _write_files(self, count):
+        return [self.write_file(make_png((4, 4, 16, 0, 0, 0, 0),
+                                         random_rows(8, 4, seed=i), 2),
+                                '{}.png'.format(i))
+                for i in range(count)]
+
+    def test_hits_and_formats(self):
+        file_name, = self._write_files(1)
+        cache = image_cache.ImageCache()
+        png_image = cache.get_image(file_name)
+        self.assertIs(cache.get_image(file_name), png_image)
+        eight_bit = cache.get_image(file_name, to_8bit=True)
+        self.assertEqual(eight_bit.pixels.itemsize, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(cache.size, 16 * 2 + 16)
+
+    def test_byte_budget(self):
+        first, second, third = self._write_files(3)
+        cache = image_cache.ImageCache(max_size=64)
+        cache.get_image(first)
+        cache.get_image(second)
+        cache.get_image(first)
+        cache.get_image(third)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        cache.get_image(first)
+        self.assertEqual(cache.misses, 3)
+        cache.get_image(second)
+        self.assertEqual(cache.misses, 4)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'),
+                         'Open files can not be listed')
+    def test_files_released(self):
+        file_names = self._write_files(5)
+        cache = image_cache.ImageCache()
+        # reference cycles must not be what keeps the files open
+        gc.disable()
+        try:
+            open_files = len(os.listdir('/proc/self/fd'))
+            images = [cache.get_image(file_name) for file_name in file_names]
+            self.assertEqual(len(os.listdir('/proc/self/fd')), open_files)
+        finally:
+            gc.enable()
+        self.assertIsNone(images[0].reader)
+        self.assertEqual(len(images[0].rgb_representation()), 4)
+
+
+class RegionTests(PNGFileTestCase):
+    def test_region(self):
+        rows = random_rows(15, 6)
+        file_name = self.write_png((5, 6, 8, 2, 0, 0, 0), rows, 3)
+        reader = png_reader.Reader(file_name, True)
+        region_image = reader.decode_region(1, 2, 4, 5)
+        self.assertEqual((region_image.width, region_image.height), (3, 3))
+        self.assertEqual([bytes(row) for row in region_image.bit_map],
+                         [row[3:12] for row in rows[2:5]])
+
+    def test_sub_byte_region(self):
+        rows = [bytes([0b00011011, 0b11100100])] * 2
+        file_name = self.write_png((8, 2, 2, 0, 0, 0, 0), rows, 1)
+        region_image = png_reader.Reader(file_name, True).decode_region(
+            3, 1, 6, 2)
+        self.assertEqual(list(region_image.pixels), [3, 3, 2])
+
+    def test_stops_inflating(self):
+        file_name = self.write_png((4, 100, 8, 0, 0, 0, 0),
+                                   random_rows(4, 100), 1, idat_size=8)
+        reader = png_reader.Reader(file_name, True)
+        decode_stats = stats.DecodeStats()
+        reader.stats = decode_stats
+        reader.decode_region(0, 0, 4, 2)
+        self.assertLess(decode_stats.stages['inflate'].size, 100)
+
+    def test_incorrect_region(self):
+        file_name = self.write_png((2, 2, 8, 0, 0, 0, 0), [b'\0\0'] * 2, 1)
+        reader = png_reader.Reader(file_name, True)
+        self.assertRaises(png_reader.PNGError, reader.decode_region,
+                          1, 0, 1, 2)
+
+
+class ThumbnailTests(PNGFileTestCase):
+    def _check_thumbnail(self):
+        rows = [bytes([0, 10, 20, 30, 40]), bytes([2, 12, 22, 32, 42]),
+                bytes([100, 100, 100, 100, 100])]
+        file_name = self.write_png((5, 3, 8, 0, 0, 0, 0), rows, 1)
+        thumbnail = png_reader.Reader(file_name, True).decode_thumbnail(3)
+        self.assertEqual((thumbnail.width, thumbnail.height,
+                          thumbnail.channels), (3, 2, 1))
+        self.assertEqual(list(thumbnail.pixels),
+                         [6, 26, 41, 100, 100, 100])
+
+    def test_thumbnail(self):
+        self._check_thumbnail()
+
+    def test_thumbnail_without_numpy(self):
+        with patch.object(image, 'numpy', None):
+            self._check_thumbnail()
+
+    def test_palette_thumbnail(self):
+        file_name = self.write_png((2, 2, 1, 3, 0, 0, 0),
+                                   [b'\x40', b'\x80'], 1,
+                                   chunks=[(b'PLTE', b'\x00\x00\x00'
+                                                     b'\xff\x80\x00')])
+        thumbnail = png_reader.Reader(file_name, True).decode_thumbnail(1)
+        self.assertEqual((thumbnail.channels, list(thumbnail.pixels)),
+                         (3, [128, 64, 0]))
+
+
+class PipelineTests(PNGFileTestCase):
+    def setUp(self):
+        super().setUp()
+        # the pipeline is tested on machines with a single CPU as well
+        patcher = patch.object(pipeline, 'MIN_CPU_COUNT', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_as_serial(self):
+        rows = random_rows(30, 40)
+        file_name = self.write_png((10, 40, 8, 2, 0, 0, 0), rows, 3,
+                                   idat_size=50)
+        with patch.object(pipeline, 'PIECE_SIZE', 64), \
+                patch.object(pipeline, 'BATCH_SIZE', 100):
+            reader = png_reader.Reader(file_name, pipelined=True)
+            self.assertTrue(reader.pipelined)
+        self.assertEqual([bytes(row) for row in reader.image.bit_map], rows)
+
+    def test_single_cpu(self):
+        file_name = self.write_png((10, 40, 8, 2, 0, 0, 0),
+                                   random_rows(30, 40), 3)
+        with patch.object(os, 'cpu_count', return_value=1), \
+                patch.object(pipeline, 'MIN_CPU_COUNT', 2):
+            reader = png_reader.Reader(file_name, pipelined=True)
+        self.assertFalse(reader.pipelined)
+
+    def test_crc_error(self):
+        file_name = self.write_png((10, 40, 8, 2, 0, 0, 0),
+                                   random_rows(30, 40), 3, idat_size=50)
+        with open(file_name, 'r+b') as f:
+            data = f.read()
+            f.seek(data.rindex(b'IDAT') + 4)
+            f.write(b'\xff')
+        messages = []
+        for pipelined in (False, True):
+            with self.assertRaises(png_reader.PNGError) as context:
+                png_reader.Reader(file_name, pipelined=pipelined)
+            messages.append(str(context.exception))
+        self.assertEqual(messages[0], messages[1])
+
+    def test_integrity_levels(self):
+        rows = random_rows(30, 40)
+        for interlace_method in (0, 1):
+            file_name = self.write_png((10, 40, 8, 2, 0, 0, interlace_method),
+                                       rows, 3, idat_size=50)
+            for integrity in png_reader.INTEGRITY_LEVELS:
+                with self.subTest(integrity=integrity,
+                                  interlace_method=interlace_method):
+                    reader = png_reader.Reader(
+                        file_name, pipelined=True, integrity=integrity)
+                    self.assertEqual(
+                        [bytes(row) for row in reader.image.bit_map], rows)
+
+
+class IntegrityTests(PNGFileTestCase):
+    def write_corrupted(self, chunk_type, in_data=False):
+        """Writes a file with a zero CRC of the chunk of chunk_type or,
+        if in_data, with its first data byte zeroed instead"""
+        file_name = self.write_png(
+            (3, 4, 8, 0, 0, 0, 0), random_rows(3, 4), 1,
+            chunks=[(b'tEXt', b'a\x00b')])
+        with open(file_name, 'r+b') as f:
+            data = f.read()
+            type_offset = data.index(chunk_type)
+            length = struct.unpack_from('!L', data, type_offset - 4)[0]
+            if in_data:
+                f.seek(type_offset + 4)
+                f.write(b'\x00')
+            else:
+                f.seek(type_offset + 4 + length)
+                f.write(b'\x00\x00\x00\x00')
+        return file_name
+
+    def test_ancillary_crc(self):
+        file_name = self.write_corrupted(b'tEXt')
+        self.assertRaises(png_reader.PNGError, png_reader.Reader, file_name)
+        for integrity in ('critical', 'off'):
+            png_reader.Reader(file_name, integrity=integrity)
+
+    def test_deferred_crc(self):
+        file_name = self.write_corrupted(b'IDAT')
+        messages = []
+        for integrity in ('full', 'deferred'):
+            with self.assertRaises(png_reader.PNGError) as context:
+                png_reader.Reader(file_name, integrity=integrity)
+            messages.append(str(context.exception))
+        self.assertEqual(messages[0], messages[1])
+        png_reader.Reader(file_name, integrity='off')
+
+        # streams are inflated while they are read, but a broken zlib
+        # stream is reported as the CRC error that causes it
+        with open(self.write_corrupted(b'IDAT', in_data=True), 'rb') as f:
+            data = f.read()
+        for integrity in ('full', 'deferred'):
+            with self.assertRaises(png_reader.PNGError) as context:
+                png_reader.Reader(ShortReadStream(data, 7),
+                                  integrity=integrity)
+            messages.append(str(context.exception))
+        self.assertEqual(messages[2], messages[3])
+        self.assertIn('Control sum', messages[3])
+
+    def test_deferred_crc_without_decoding(self):
+        file_name = self.write_corrupted(b'IDAT')
+        release = threading.Event()
+        check_crcs = png_reader.Reader._check_crcs
+
+        def slow_check_crcs(reader, chunks):
+            release.wait(5)
+            check_crcs(reader, chunks)
+
+        with patch.object(png_reader.Reader, '_check_crcs', slow_check_crcs):
+            reader = png_reader.Reader(file_name, True, integrity='deferred')
+            # the check overlaps decoding instead of delaying the reader
+            self.assertFalse(reader._crc_check.done())
+            release.set()
+            self.assertRaisesRegex(png_reader.PNGError, 'Control sum',
+                                   list, reader.iter_rows())
+        for decode in (lambda: list(reader.iter_passes()),
+                       lambda: reader.decode_region(0, 0, 1, 1),
+                       lambda: reader.decode_thumbnail(2),
+                       reader.finish_crc_check):
+            self.assertRaisesRegex(png_reader.PNGError, 'Control sum', decode)
+
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [RED]),
+                                (0, 0, 1, 1, 0, 0, [BLUE])])
+        # the last byte of the fdAT chunk data
+        offset = data.rindex(b'IEND') - 9
+        data = data[:offset] + b'\x00' + data[offset + 1:]
+        reader = png_reader.Reader(data, True, integrity='deferred')
+        self.assertRaisesRegex(png_reader.PNGError, 'Control sum',
+                               reader.animation.get_frame, 1)
+
+    def test_stream_end(self):
+        rows = [b'\x00\x01\x02'] * 2
+        compressed = zlib.compress(b''.join(b'\x00' + row for row in rows))
+        file_name = self.write_file(join_chunks(
+            (3, 2, 8, 0, 0, 0, 0), [(b'IDAT', compressed[:-4])]))
+        self.assertRaises(png_reader.PNGError, png_reader.Reader, file_name)
+        reader = png_reader.Reader(file_name, integrity='off')
+        self.assertEqual([bytes(row) for row in reader.image.bit_map], rows)
+
+    def test_corrupted_zlib_data(self):
+        # the CRC is correct, but the first block has the reserved type 3
+        data = join_chunks((3, 2, 8, 0, 0, 0, 0),
+                           [(b'IDAT', b'\x78\x9c\xff\xff\xff\xff')])
+        file_name = self.write_file(data)
+        with patch.object(pipeline, 'MIN_CPU_COUNT', 1):
+            for source in (file_name, data):
+                for pipelined in (False, True):
+                    for integrity in png_reader.INTEGRITY_LEVELS:
+                        with self.subTest(source=type(source),
+                                          pipelined=pipelined,
+                                          integrity=integrity):
+                            self.assertRaisesRegex(
+                                png_reader.PNGError, 'Incorrect zlib stream',
+                                png_reader.Reader, source,
+                                pipelined=pipelined, integrity=integrity)
+        reader = png_reader.Reader(file_name, True)
+        for decode in (lambda: list(reader.iter_rows()),
+                       lambda: reader.decode_region(0, 0, 1, 1),
+                       lambda: reader.decode_thumbnail(1)):
+            self.assertRaises(png_reader.PNGError, decode)
+
+    def test_unknown_level(self):
+        file_name = self.write_png((1, 1, 8, 0, 0, 0, 0), [b'\x00'], 1)
+        self.assertRaises(ValueError, png_reader.Reader, file_name,
+                          integrity='none')
+
+
+class SourceTests(unittest.TestCase):
+    def setUp(self):
+        self.rows = random_rows(12, 9)
+        self.data = make_png((4, 9, 8, 2, 0, 0, 0), self.rows, 3,
+                             idat_size=20)
+
+    def check_rows(self, reader):
+        self.assertEqual([bytes(row) for row in reader.image.bit_map],
+                         self.rows)
+
+    def test_buffers(self):
+        self.check_rows(png_reader.Reader(self.data))
+        self.check_rows(png_reader.Reader(memoryview(bytearray(self.data))))
+
+    def test_stream(self):
+        self.check_rows(png_reader.Reader(ShortReadStream(self.data, 7)))
+
+    def test_interlaced_stream(self):
+        data = make_png((4, 9, 8, 2, 0, 0, 1), self.rows, 3, idat_size=20)
+        self.check_rows(png_reader.Reader(ShortReadStream(data, 7)))
+
+    def test_inflates_while_reading(self):
+        decode_stats = stats.DecodeStats()
+        inflated = []
+
+        def on_read(offset):
+            if offset >= len(self.data) - 12:
+                inflated.append(decode_stats.stages['inflate'].size)
+
+        png_reader.Reader(ShortReadStream(self.data, 7, on_read),
+                          stats=decode_stats)
+        self.assertTrue(inflated)
+        self.assertGreater(inflated[0], 0)
+
+    def test_lazy_stream(self):
+        stream = ShortReadStream(self.data, 7)
+        reader = png_reader.Reader(stream, True, lazy=True)
+        # the stream is read up to the header of the first IDAT chunk
+        self.assertLess(stream.offset, self.data.index(b'IDAT') + 7)
+        rows = reader.iter_rows()
+        self.assertEqual(bytes(next(rows)), self.rows[0])
+        self.assertLess(stream.offset, len(self.data))
+        self.assertEqual([bytes(row) for row in rows], self.rows[1:])
+        self.assertEqual(stream.offset, len(self.data))
+        self.assertEqual(len(reader.idat_list), reader.idat_count)
+
+        data = make_png((4, 9, 8, 2, 0, 0, 1), self.rows, 3, idat_size=20)
+        reader = png_reader.Reader(ShortReadStream(data, 7), True, lazy=True)
+        self.assertEqual([bytes(row) for row in reader.iter_rows()],
+                         self.rows)
+
+    def test_lazy_stream_errors(self):
+        # a CRC error in the last IDAT chunk and a missing IEND chunk
+        offset = self.data.rindex(b'IEND') - 5
+        for data in (self.data[:offset] + b'\x00' + self.data[offset + 1:],
+                     self.data[:-12]):
+            for integrity in ('full', 'deferred'):
+                reader = png_reader.Reader(ShortReadStream(data, 7), True,
+                                           integrity=integrity, lazy=True)
+                self.assertRaises(png_reader.PNGError, list,
+                                  reader.iter_rows())
+
+    def test_probe_stream(self):
+        probe = png_reader.Probe(ShortReadStream(self.data, 5), True)
+        self.assertEqual(probe.header.height, 9)
+        self.assertEqual([chunk.type for chunk in probe.chunk_index],
+                         [chunk.type for chunk in
+                          png_reader.Reader(self.data, True).chunk_index])
+
+    def test_truncated_stream(self):
+        self.assertRaises(png_reader.PNGError, png_reader.Reader,
+                          ShortReadStream(self.data[:-6], 7))
+
+    def test_disk_cache_needs_file(self):
+        self.assertRaises(ValueError, png_reader.Reader, self.data,
+                          cache=disk_cache.DiskCache())
+
+
+class AnimationTests(unittest.TestCase):
+    def test_index(self):
+        data = make_apng(2, 1, [(0, 0, 2, 1, 0, 0, [RED * 2]),
+                                (1, 0, 1, 1, 0, 0, [BLUE])], num_plays=3)
+        animation = png_reader.Reader(data, True).animation
+        self.assertEqual((len(animation), animation.num_plays), (2, 3))
+        self.assertTrue(animation.default_frame)
+        self.assertEqual(len(animation.cache), 0)
+        self.assertIsNone(png_reader.Reader(
+            make_png((1, 1, 8, 0, 0, 0, 0), [b'\x00'], 1)).animation)
+
+    def test_dispose_and_blend(self):
+        half_green = b'\x00\xff\x00\x80'
+        data = make_apng(2, 1, [(0, 0, 2, 1, 0, 0, [RED * 2]),
+                                (1, 0, 1, 1, 1, 1, [half_green]),
+                                (0, 0, 1, 1, 2, 0, [BLUE]),
+                                (0, 0, 1, 1, 0, 1, [CLEAR])])
+        animation = png_reader.Reader(data, True).animation
+        self.assertEqual([animation.get_frame(i).pixels for i in range(4)],
+                         [RED * 2, RED + b'\x7f\x80\x00\xff',
+                          BLUE + CLEAR, RED + CLEAR])
+        self.assertEqual(animation.get_frame(1).delay, 0.1)
+
+    def test_blend_without_numpy(self):
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [b'\x00\x00\xff\x80']),
+                                (0, 0, 1, 1, 0, 1, [b'\xff\x00\x00\x80'])])
+        animation = png_reader.Reader(data, True).animation
+        with patch.object(apng, 'numpy', None):
+            frame = animation.get_frame(1)
+        self.assertEqual(frame.pixels, b'\xaa\x00\x55\xc0')
+
+    def test_hidden_default_image(self):
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [BLUE])],
+                         hidden_default=True)
+        reader = png_reader.Reader(data)
+        self.assertEqual(bytes(reader.image.pixels), CLEAR)
+        self.assertFalse(reader.animation.default_frame)
+        self.assertEqual(reader.animation.get_frame(0).pixels, BLUE)
+
+    def test_lazy_decoding(self):
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [RED]),
+                                (0, 0, 1, 1, 0, 1, [BLUE]),
+                                (0, 0, 1, 1, 0, 1, [CLEAR])])
+        reader = png_reader.Reader(data, True)
+        with patch.object(reader, 'decode_frame',
+                          wraps=reader.decode_frame) as decode_frame:
+            self.assertEqual(reader.animation.get_frame(1).pixels, BLUE)
+            self.assertEqual(decode_frame.call_count, 2)
+            reader.animation.cache.discard(2)
+            self.assertEqual(reader.animation.get_frame(0).pixels, RED)
+            self.assertEqual(reader.animation.get_frame(2).pixels, BLUE)
+            self.assertEqual(decode_frame.call_count, 3)
+
+    def test_sequence_error(self):
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [RED]),
+                                (0, 0, 1, 1, 0, 0, [BLUE])])
+        data = data.replace(b'fdAT\x00\x00\x00\x02',
+                            b'fdAT\x00\x00\x00\x05')
+        self.assertRaises(png_reader.PNGError, png_reader.Reader, data,
+                          integrity='off')
+
+    def test_corrupted_frame_data(self):
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [RED]),
+                                (0, 0, 1, 1, 0, 0, [BLUE])])
+        compressed = zlib.compress(b'\x00' + BLUE)
+        # integrity 'off' ignores the CRC that no longer matches
+        data = data.replace(compressed, compressed[:2] +
+                            b'\xff' * (len(compressed) - 2))
+        animation = png_reader.Reader(data, integrity='off').animation
+        self.assertRaisesRegex(png_reader.PNGError, 'Incorrect zlib stream',
+                               animation.get_frame, 1)
+
+    def test_frame_region_error(self):
+        data = make_apng(1, 1, [(0, 0, 1, 1, 0, 0, [RED]),
+                                (1, 0, 1, 1, 0, 0, [BLUE])])
+        self.assertRaises(png_reader.PNGError, png_reader.Reader, data)
+
+
 if __name__ == '__main__':
     unittest.main()